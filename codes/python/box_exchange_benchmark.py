@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+'''Compare the two ways of exchanging edge and corner ghosts for box
+stencils in distributed_computing_universal.py.
+
+"direct" sends one message to each of the 26 neighbours at once, while
+"staged" sends only the 6 face messages but in three consecutive stages
+(X, then Y, then Z) so that the corners travel along with the faces.
+The plain face-only "star" exchange is timed for reference. Each is
+timed with point-to-point messages, with neighbourhood collectives
+(where possible) and with shared memory copies between the ranks of a
+node, with and without persistent requests, so the output also tells
+which GHOST_EXCHANGE method to use on this cluster. Run this
+at the rank counts used in production, as the balance between message
+count and latency depends on both the network and the rank count.
+
+Usage: mpirun -n P python3 box_exchange_benchmark.py [nz ny nx [width [repeats]]]
+
+where nz, ny, nx is the size of the lattice on each rank (without the
+ghost points), width the stencil width and repeats the number of
+exchanges to time.
+'''
+import sys
+import numpy
+import mpi4py
+from mpi4py import MPI
+from distributed_computing_universal import (rankinfo, topology, ghost_data,
+                                             initialise_values,
+                                             ghost_exchange_start,
+                                             ghost_exchange_finish)
+
+METHODS = [("star", {"stencil": "star"}),
+           ("staged", {"stencil": "box", "box_exchange": "staged"}),
+           ("direct", {"stencil": "box", "box_exchange": "direct"})]
+
+def time_exchange(cartesian_topology, local_array, ghosts, repeats):
+    '''Return the time the slowest rank took for "repeats" exchanges.'''
+    ghost_exchange_finish(ghost_exchange_start(cartesian_topology,
+                                               local_array, ghosts))
+    cartesian_topology.topology.Barrier()
+    start = MPI.Wtime()
+    for repeat in range(repeats):
+        ghost_exchange_finish(ghost_exchange_start(cartesian_topology,
+                                                   local_array, ghosts))
+    elapsed = numpy.array(MPI.Wtime()-start)
+    elapsed_max = numpy.zeros_like(elapsed)
+    cartesian_topology.topology.Allreduce([elapsed, MPI.DOUBLE],
+                                          [elapsed_max, MPI.DOUBLE],
+                                          op=MPI.MAX)
+    return float(elapsed_max)
+
+def main(sizes, width, repeats):
+    '''Time all methods, with and without persistent requests, check that
+    the box exchanges agree and report the timings on rank 0.'''
+    me = rankinfo(sizes=sizes, stencil_width=width)
+    cartesian_topology = topology(me)
+    timings = {}
+    results = {}
+    for name, kwargs in METHODS:
+        for method in ["p2p", "neighbourhood", "shared"]:
+            for persistent in [False, True]:
+                try:
+                    ghosts = ghost_data(cartesian_topology, me.localsizes,
+                                        persistent=persistent, method=method,
+                                        **kwargs)
+                except ValueError:
+                    # not every combination is possible everywhere
+                    continue
+                local_array = initialise_values(me, cartesian_topology,
+                                                ghostdefs=ghosts)
+                timings[(name, method, persistent)] = time_exchange(
+                    cartesian_topology, local_array, ghosts, repeats)
+                results[name] = local_array.copy()
+                ghosts.free_requests()
+                ghosts.free_arrays()
+    agree = numpy.array(numpy.array_equal(results["staged"], results["direct"]),
+                        dtype=numpy.int32)
+    agree_all = numpy.zeros_like(agree)
+    cartesian_topology.topology.Allreduce([agree, MPI.INT], [agree_all, MPI.INT],
+                                          op=MPI.LAND)
+    if (me.rank == 0):
+        print("lattice {sizes} per rank, stencil width {width}, {size} ranks "
+              "as {dims}, {repeats} exchanges".format(
+                  sizes=sizes, width=width, size=me.size,
+                  dims=cartesian_topology.dims, repeats=repeats))
+        print("{:>8} {:>14} {:>11} {:>14}".format("exchange", "method",
+                                                  "persistent",
+                                                  "time/exchange"))
+        for (name, method, persistent), elapsed in timings.items():
+            print("{:>8} {:>14} {:>11} {:>14.3e}".format(
+                name, method, str(persistent), elapsed/repeats))
+        for stencil in ["star", "box"]:
+            best = min([key for key in timings
+                        if (key[0] == "star") == (stencil == "star")],
+                       key=lambda key: timings[key])
+            print("Fastest {stencil} exchange: {name} with {method} "
+                  "(persistent={persistent})".format(
+                      stencil=stencil, name=best[0], method=best[1],
+                      persistent=best[2]))
+        print("Staged and direct ghosts agree: {agree}".format(
+            agree=bool(agree_all)))
+    return timings
+
+if (__name__ == "__main__"):
+    sizes = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else [32, 32, 32]
+    width = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    repeats = int(sys.argv[5]) if len(sys.argv) > 5 else 100
+    main(sizes, width, repeats)
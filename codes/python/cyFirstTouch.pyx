@@ -0,0 +1,55 @@
+import cython,numpy
+from cython.parallel import prange, parallel
+from libc.string cimport memset
+cimport numpy
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+def first_touch(numpy.ndarray array, int N):
+    '''Zero the C contiguous "array" with N threads, each writing the planes
+    (along the first axis) that the same thread of cyLaplacian6 computes.
+
+    Linux places a page on the NUMA node of the thread which first writes
+    to it, so an array filled on the main thread lives on one node and
+    the other sockets read it remotely. Here the interior planes
+    1..shape[0]-2 are shared out exactly like prange(1,xmax-1) in
+    cyLaplacian6 with a static schedule, and the boundary planes go with
+    their neighbours. Set OMP_SCHEDULE=static when running cyLaplacian6 so
+    its threads then find their planes in local memory; the array must
+    not have been written to before.'''
+    if (not array.flags["C_CONTIGUOUS"]):
+        raise ValueError("first_touch needs a C contiguous array")
+    if (array.size == 0):
+        return array
+    cdef int xmax = array.shape[0]
+    cdef size_t plane = array.nbytes//xmax
+    cdef char *base = <char *>array.data
+    cdef int num_threads = N
+    cdef int ii
+    if (xmax < 3):
+        memset(base, 0, array.nbytes)
+        return array
+    with nogil, parallel(num_threads=num_threads):
+        for ii in prange(1,xmax-1,schedule="static"):
+            memset(base+ii*plane, 0, plane)
+            if (ii == 1):
+                memset(base, 0, plane)
+            if (ii == xmax-2):
+                memset(base+(xmax-1)*plane, 0, plane)
+    return array
+
+def empty(shape, int N, dtype=numpy.float64):
+    '''Return a new array of zeros of "shape" and "dtype" placed on the NUMA
+    nodes of the N threads of cyLaplacian6, see first_touch.'''
+    return first_touch(numpy.empty(shape, dtype=dtype), N)
+
+def first_touch_init(size, int N):
+    '''Return the arguments of the kernels for a size**3 lattice like Init in
+    optimising_laplacian.py, with both lattices first touched by N threads.
+    The random values are written after the pages have been placed, so
+    filling them from one thread does not move them.'''
+    d=numpy.array([0.1,0.1,0.1])
+    data=empty([size]*3, N)
+    numpy.random.default_rng().random(out=data)
+    lapl=empty([size]*3, N)
+    return {"data": data, "laplacian": lapl, "lattice_spacing": d}
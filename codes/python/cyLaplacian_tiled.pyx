@@ -0,0 +1,47 @@
+import cython,numpy
+from cython.parallel import prange, parallel
+cimport numpy
+DTYPE=numpy.float64
+ctypedef numpy.float64_t DTYPE_t
+# the cache the tiles should fit in half of, see the sizing of tj below
+L2_BYTES = 262144
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+def cyLaplacian_tiled(numpy.ndarray[DTYPE_t, ndim=3] data, numpy.ndarray[DTYPE_t, ndim=3] lapl, numpy.ndarray[DTYPE_t, ndim=1] d, int N, int tj=0, int tk=0):
+    '''cyLaplacian6 blocked for the cache: the jj/kk plane is cut into
+    tiles of tj x tk points and each thread streams through its tiles
+    along ii. The three planes ii-1, ii and ii+1 of a tile stay in L2, so
+    every point of "data" is read from memory only once. By default tk
+    is the whole row, to keep the inner loop long and contiguous, and tj
+    as large as fits.'''
+    cdef int xmax = data.shape[0]
+    cdef int ymax = data.shape[1]
+    cdef int zmax = data.shape[2]
+    cdef int num_threads = N
+    cdef double dx2 = 1./(d[0]*d[0])
+    cdef double dy2 = 1./(d[1]*d[1])
+    cdef double dz2 = 1./(d[2]*d[2])
+    if (tk <= 0):
+        tk = zmax-2
+    if (tj <= 0):
+        # tj rows of tk doubles (8 bytes) in each of three planes of data
+        # and one of lapl, in half of L2_BYTES
+        tj = max(1, min(ymax-2, L2_BYTES//(2*4*8*tk)))
+    cdef int ntj = (ymax-2+tj-1)//tj
+    cdef int ntk = (zmax-2+tk-1)//tk
+    cdef int tile, j0, j1, k0, k1, ii, jj, kk
+    with nogil, parallel(num_threads=num_threads):
+        for tile in prange(ntj*ntk, schedule="static"):
+            j0 = 1+(tile//ntk)*tj
+            j1 = j0+tj if j0+tj < ymax-1 else ymax-1
+            k0 = 1+(tile%ntk)*tk
+            k1 = k0+tk if k0+tk < zmax-1 else zmax-1
+            for ii in range(1,xmax-1):
+                for jj in range(j0,j1):
+                    for kk in range(k0,k1):
+                        lapl[ii,jj,kk] = (
+                            (data[ii-1,jj,kk] - 2*data[ii,jj,kk] + data[ii+1,jj,kk])*dx2 +
+                            (data[ii,jj-1,kk] - 2*data[ii,jj,kk] + data[ii,jj+1,kk])*dy2 +
+                            (data[ii,jj,kk-1] - 2*data[ii,jj,kk] + data[ii,jj,kk+1])*dz2)
+    return
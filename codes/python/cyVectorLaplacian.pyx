@@ -0,0 +1,64 @@
+import cython,numpy
+from cython.parallel import prange, parallel
+cimport numpy
+DTYPE=numpy.float64
+ctypedef numpy.float64_t DTYPE_t
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+def cyVectorLaplacian(numpy.ndarray[DTYPE_t, ndim=4] data, numpy.ndarray[DTYPE_t, ndim=4] lapl, numpy.ndarray[DTYPE_t, ndim=1] d, int N):
+    '''cyLaplacian6 for the interleaved (nx, ny, nz, ncomp) layout of a
+    DMDA with dof=ncomp. The components of a row are adjacent in memory,
+    so each row is treated as one row of nz*ncomp values whose neighbours
+    along z are ncomp values away: every neighbour row is loaded once for
+    all components and the inner loop stays long and contiguous.'''
+    cdef int xmax = data.shape[0]
+    cdef int ymax = data.shape[1]
+    cdef int cmax = data.shape[3]
+    cdef int mmax = data.shape[2]*cmax
+    cdef numpy.ndarray[DTYPE_t, ndim=3] rows = data.reshape(xmax, ymax, mmax)
+    cdef numpy.ndarray[DTYPE_t, ndim=3] lapl_rows = lapl.reshape(xmax, ymax, mmax)
+    cdef int num_threads = N
+    cdef double dx2 = 1./(d[0]*d[0])
+    cdef double dy2 = 1./(d[1]*d[1])
+    cdef double dz2 = 1./(d[2]*d[2])
+    cdef int ii, jj, mm
+    if (not numpy.may_share_memory(lapl_rows, lapl)):
+        raise ValueError("cyVectorLaplacian needs lapl contiguous in its last two axes")
+    with nogil, parallel(num_threads=num_threads):
+        for ii in prange(1,xmax-1,schedule="runtime"):
+            for jj in range(1,ymax-1):
+                for mm in range(cmax,mmax-cmax):
+                    lapl_rows[ii,jj,mm] = (
+                        (rows[ii-1,jj,mm] - 2*rows[ii,jj,mm] + rows[ii+1,jj,mm])*dx2 +
+                        (rows[ii,jj-1,mm] - 2*rows[ii,jj,mm] + rows[ii,jj+1,mm])*dy2 +
+                        (rows[ii,jj,mm-cmax] - 2*rows[ii,jj,mm] + rows[ii,jj,mm+cmax])*dz2)
+    return
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+def cyStackedLaplacian(numpy.ndarray[DTYPE_t, ndim=4] data, numpy.ndarray[DTYPE_t, ndim=4] lapl, numpy.ndarray[DTYPE_t, ndim=1] d, int N):
+    '''cyLaplacian6 for a (ncomp, nx, ny, nz) stack of fields: each thread
+    does all components of its planes before moving on, so the three
+    planes of every component a row needs are still in cache, instead of
+    streaming the whole lattice once per component.'''
+    cdef int cmax = data.shape[0]
+    cdef int xmax = data.shape[1]
+    cdef int ymax = data.shape[2]
+    cdef int zmax = data.shape[3]
+    cdef int num_threads = N
+    cdef double dx2 = 1./(d[0]*d[0])
+    cdef double dy2 = 1./(d[1]*d[1])
+    cdef double dz2 = 1./(d[2]*d[2])
+    cdef int ii, jj, kk, cc
+    with nogil, parallel(num_threads=num_threads):
+        for ii in prange(1,xmax-1,schedule="runtime"):
+            for cc in range(cmax):
+                for jj in range(1,ymax-1):
+                    for kk in range(1,zmax-1):
+                        lapl[cc,ii,jj,kk] = (
+                            (data[cc,ii-1,jj,kk] - 2*data[cc,ii,jj,kk] + data[cc,ii+1,jj,kk])*dx2 +
+                            (data[cc,ii,jj-1,kk] - 2*data[cc,ii,jj,kk] + data[cc,ii,jj+1,kk])*dy2 +
+                            (data[cc,ii,jj,kk-1] - 2*data[cc,ii,jj,kk] + data[cc,ii,jj,kk+1])*dz2)
+    return
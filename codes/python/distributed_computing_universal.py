@@ -30,33 +30,52 @@ if (MPI.COMM_WORLD.size == 1):
 # direct MPI mode fails if it is not available; lack of numpy is also fatal
 try:
     with directview.sync_imports():
+        import concurrent.futures
+        import itertools
+        import json
+        import os
         import numpy
         import mpi4py
         from mpi4py import MPI
+        from mpi4py.util import dtlib
 except NameError:
+    import concurrent.futures
+    import itertools
+    import json
+    import os
     import numpy
     import mpi4py
     from mpi4py import MPI
+    from mpi4py.util import dtlib
     class directview_class(object):
-        '''Dummy class for direct MPI mode'''
+        '''Dummy class for direct MPI mode
+
+        Non-blocking calls run in a local pool and return a
+        concurrent.futures.Future instead of an ipyparallel AsyncResult.
+        The pool is a single thread rather than processes: forking an MPI
+        process is not safe, and every rank must run the tasks (and thus
+        their collectives) one at a time in the same order anyway.'''
+        def __init__(self):
+            self.executor = None
         def __setitem__(self, name, value):
             setattr(self, name, value)
         def __getitem__(self, name):
             return getattr(self, name)
         def parallel(self, block=True):
-            def passthrough(func):
-                def callit(*args, **kwargs):
-                    return func(*args, **kwargs)
-                return callit
-            return passthrough
+            return self.remote(block=block)
         def remote(self, block=True):
             def passthrough(func):
                 def callit(*args, **kwargs):
-                    return func(*args, **kwargs)
+                    if (block):
+                        return func(*args, **kwargs)
+                    return self.apply_async(func, *args, **kwargs)
                 return callit
             return passthrough
         def apply_async(self, func, *args, **kwargs):
-            return func(*args, **kwargs)
+            if (self.executor is None):
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1)
+            return self.executor.submit(func, *args, **kwargs)
     directview=directview_class()
 
 try:
@@ -68,9 +87,14 @@ except:
     directview=c[:]
     directview.block=True
     with directview.sync_imports():
+        import concurrent.futures
+        import itertools
+        import json
+        import os
         import numpy
         import mpi4py
         from mpi4py import MPI
+        from mpi4py.util import dtlib
 
 class rankinfo(object):
     '''This holds a few "global" values of our problem,
@@ -80,41 +104,175 @@ class rankinfo(object):
     ----------
 
     sizes : tuple of numbers of lattice points without ghost
-            points along the coordinate axes (in x,y,z order)
+            points along the coordinate axes (in z,y,x order, i.e. the
+            order of the axes of the numpy arrays); any number of
+            dimensions is fine
+    stencil_width : depth of the ghost layer, i.e. how far the
+                    stencil reaches; a deep ghost layer also allows
+                    several time steps between ghost exchanges
+    periods : periodicity of each axis; by default the first axis is
+              not periodic but all the others are
+    ownership_ranges : for an uneven decomposition, the number of lattice
+                       points of each rank along each axis (a list per
+                       axis, like the ownership ranges of a PETSc DMDA);
+                       the rank grid is then given by their lengths and
+                       "sizes" is not needed
+    dtype : the numpy dtype of the lattice data; numpy.float32 halves
+            the memory and the ghost traffic, while the reductions still
+            accumulate in float64
+    comm : the communicator to build the topology from, MPI.COMM_WORLD
+           by default; with ownership ranges its ranks are placed on the
+           rank grid in row-major order
 
     Attributes
     ----------
 
-    rank : the rank of this class in MPI.COMM_WORLD
-    size : the number of ranks in  MPI.COMM_WORLD
+    comm : the communicator to build the topology from
+    rank : the rank of this class in "comm"
+    size : the number of ranks in "comm"
     ndim : how many physical dimensions does our lattice have
     periods : periodicity of the lattice
     stencil_width : the number of ghost points needed from
                     outside of the lattice on each side
     localsizes : the number of lattice points along the
                  coordinate axes including the ghost points
+    ownership_ranges : the ownership ranges, or None if the lattice is
+                       split evenly
+    dtype : the numpy dtype of the lattice data
     '''
-    def __init__(self, sizes):
-        '''See above for details of initialisation.'''
-        self.ndim=3
-        self.periods=[False, True, True]
-        self.stencil_width = 1
-        self.rank=MPI.COMM_WORLD.Get_rank()
-        self.size=MPI.COMM_WORLD.Get_size()
+    def __init__(self, sizes=None, stencil_width=1, periods=None,
+                 ownership_ranges=None, dtype=numpy.float64, comm=None):
+        '''See above for details of initialisation.
+
+        With ownership ranges the rank grid is not reordered, so the ranks
+        of "comm" are placed on it in row-major order and we know our own
+        sizes already here.'''
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        self.rank=self.comm.Get_rank()
+        self.size=self.comm.Get_size()
+        self.dtype = numpy.dtype(dtype)
+        self.ownership_ranges = None
+        if (ownership_ranges is not None):
+            self.ownership_ranges = [[int(n) for n in ranges]
+                                     for ranges in ownership_ranges]
+            dims = [len(ranges) for ranges in self.ownership_ranges]
+            if (numpy.prod(dims) != self.size):
+                raise ValueError("Ownership ranges for {dims} ranks given on "
+                                 "{size} ranks".format(dims=dims,
+                                                       size=self.size))
+            mycoord = numpy.unravel_index(self.rank, dims)
+            sizes = [ranges[x] for ranges, x in zip(self.ownership_ranges,
+                                                    mycoord)]
+        self.ndim=len(sizes)
+        if (periods is None):
+            periods = [False]+[True]*(self.ndim-1)
+        self.periods=list(periods)
+        self.stencil_width = stencil_width
+        if (min(sizes) < stencil_width):
+            raise ValueError("Every rank needs at least {sw} lattice points "
+                             "along each axis".format(sw=stencil_width))
         self.localsizes=[x+self.stencil_width*2 for x in sizes]
 directview["rankinfo"]=rankinfo
 
 def serialised_print(msg, topo):
-    '''Print out a message from every rank syncronously in rank-order.
-    Barrier() is global, so every rank must call it or we deadlock.'''
-    myrank = topo.Get_rank()
-    for rankid in range(0,topo.Get_size()):
-        if (myrank == rankid):
-            print(msg)
-        topo.Barrier()
+    '''Print out a message from every rank in rank-order. The messages
+    are gathered to rank 0 which prints them all: gather() is collective,
+    so every rank must call it or we deadlock.'''
+    msgs = topo.gather(str(msg), root=0)
+    if (topo.Get_rank() == 0):
+        print("\n".join(msgs))
     return
 directview["serialised_print"]=serialised_print
 
+class rank_logger(object):
+    '''Write out messages from every rank.
+
+    In "gather" mode each call to log() prints the messages of all ranks
+    in rank order like serialised_print. In "mpiio" mode they are appended
+    to "filename" in rank order with the collective Write_ordered(). Both
+    are collective, so every rank must call log() or we deadlock.
+
+    The "async" mode is for diagnostics written on every step: log() just
+    adds the message to a buffer on this rank and only once there is
+    "buffersize" bytes of it the buffer is appended to "filename" with a
+    non-blocking Iwrite_shared(). Nothing is collective until close(), so
+    the ranks never wait for each other, but the blocks of messages of the
+    ranks end up in the file in whichever order they were written: put
+    the rank and step in the messages.
+
+    Parameters
+    ----------
+    comm : the communicator of the ranks logging
+    mode : "gather", "mpiio" or "async"
+    filename : the file to append to in "mpiio" and "async" modes
+    buffersize : the number of bytes to buffer in "async" mode
+
+    Attributes
+    ----------
+    file : the MPI.File open for appending in "mpiio" and "async" modes
+    buffer : a list of the messages not yet written in "async" mode
+    buffered : the number of bytes in buffer
+    pending : a list of the write requests in flight and their buffers
+
+    Methods
+    -------
+    log : log a message
+    flush : start writing out the buffered messages
+    close : write out everything and close the file
+    '''
+    def __init__(self, comm, mode="gather", filename=None, buffersize=65536):
+        '''See above for details of initialisation.'''
+        if (mode not in ("gather", "mpiio", "async")):
+            raise ValueError("Unknown logging mode {mode}".format(mode=mode))
+        if (mode != "gather" and filename is None):
+            raise ValueError("Logging mode {mode} needs a filename".format(
+                mode=mode))
+        self.comm = comm
+        self.mode = mode
+        self.buffersize = buffersize
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+        self.file = None
+        if (mode != "gather"):
+            self.file = MPI.File.Open(comm, filename, MPI.MODE_WRONLY |
+                                      MPI.MODE_CREATE | MPI.MODE_APPEND)
+    def log(self, msg):
+        '''Log "msg" of this rank, or nothing if it is None; collective
+        except in "async" mode.'''
+        if (self.mode == "gather"):
+            msgs = self.comm.gather(msg, root=0)
+            if (self.comm.Get_rank() == 0):
+                print("\n".join(str(msg) for msg in msgs if msg is not None))
+        elif (self.mode == "mpiio"):
+            self.file.Write_ordered(
+                bytearray("" if msg is None else str(msg)+"\n", "utf-8"))
+        elif (msg is not None):
+            self.buffer.append(str(msg)+"\n")
+            self.buffered += len(self.buffer[-1])
+            if (self.buffered >= self.buffersize):
+                self.flush()
+    def flush(self):
+        '''Start appending the buffered messages to the file, forgetting
+        about the earlier writes which have finished.'''
+        self.pending = [(request, data) for request, data in self.pending
+                        if not request.Test()]
+        if (len(self.buffer) > 0):
+            # the buffer must stay alive until the write finishes
+            data = bytearray("".join(self.buffer), "utf-8")
+            self.pending.append((self.file.Iwrite_shared(data), data))
+            self.buffer = []
+            self.buffered = 0
+    def close(self):
+        '''Write out everything and close the file; collective.'''
+        if (self.file is not None):
+            self.flush()
+            MPI.Request.Waitall([request for request, data in self.pending])
+            self.pending = []
+            self.file.Close()
+            self.file = None
+directview["rank_logger"]=rank_logger
+
 class topology(object):
     '''This class holds information related to the topology of the MPI
     Cartesian Topology
@@ -131,128 +289,727 @@ class topology(object):
     are used to find who those neighbours are.
 
     '''
-    def __init__(self, rankinfo):
+    def __init__(self, rankinfo, plan=None):
         '''Find out the best distribution of the lattice amonst the ranks of the
         communicator passed inside "rankinfo", create the topology, and
         save information about the neighbours of present rank.
 
+        If a decomposition_plan is given, its rank grid, rank placement and
+        ownership ranges (if the lattice does not divide evenly) are used
+        instead: the ranks of plan.comm are already in Cartesian order, so
+        the topology is created with reorder=False. The same goes for a
+        rankinfo with ownership ranges, where the rank grid is given by
+        the ranges.
+
         Parameters
         ----------
         rankinfo : a rankinfo instance describing current communicator
+        plan : an optional decomposition_plan of the lattice
 
         Attributes
         ----------
         dims : dimensions of the cartesian MPI rank grid (not lattice!)
         topology : the new cartesian topology communicator
-        shifts : a dict of dicts of which rank to talk to when going
-                 along "X", "Y", or "Z" direcion in "up" or "down"
-                 direction
+        shifts : a list of dicts of which rank to talk to when going
+                 along each axis in "up" or "down" direction; the axes
+                 are numbered like the axes of the local numpy arrays,
+                 so in 3D axis 0 is "Z" and axis 2 is "X"
+        ownership_ranges : the number of lattice points (without ghost
+                           points) of each rank along each axis
+        globalsizes : the number of lattice points of the global lattice
+        corner : the global coordinates of the first interior point of
+                 this rank
 
         '''
         self.me=rankinfo
-        self.dims=MPI.Compute_dims(self.me.size, self.me.ndim)
-        self.topology=MPI.COMM_WORLD.Create_cart(self.dims,
-                                                 periods=self.me.periods, reorder=True)
-        left,right = self.topology.Shift(0,1)
-        front,back = self.topology.Shift(1,1)
-        up,down = self.topology.Shift(2,1)
-        self.shifts={"X": {"up": up, "down": down},
-                     "Y": {"up": back, "down": front},
-                     "Z": {"up": right, "down": left}}
+        if (self.me.ownership_ranges is not None):
+            if (plan is not None):
+                raise ValueError("Ownership ranges already place the ranks")
+            self.dims=[len(ranges) for ranges in self.me.ownership_ranges]
+            self.topology=self.me.comm.Create_cart(self.dims,
+                                                   periods=self.me.periods, reorder=False)
+        elif (plan is None):
+            self.dims=MPI.Compute_dims(self.me.size, self.me.ndim)
+            self.topology=self.me.comm.Create_cart(self.dims,
+                                                   periods=self.me.periods, reorder=True)
+        else:
+            self.dims=list(plan.dims)
+            self.topology=plan.comm.Create_cart(self.dims,
+                                                periods=self.me.periods, reorder=False)
+        self.shifts=[]
+        for axis in range(self.me.ndim):
+            down,up = self.topology.Shift(axis,1)
+            self.shifts.append({"up": up, "down": down})
+        mycoord = self.topology.Get_coords(self.topology.Get_rank())
+        if (plan is not None and plan.ownership_ranges is not None):
+            self.ownership_ranges = plan.ownership_ranges
+        elif (self.me.ownership_ranges is None):
+            sw = self.me.stencil_width
+            self.ownership_ranges = [[n-2*sw]*d for n, d in
+                                     zip(self.me.localsizes, self.dims)]
+        else:
+            self.ownership_ranges = self.me.ownership_ranges
+        self.globalsizes = [sum(ranges) for ranges in self.ownership_ranges]
+        self.corner = [sum(ranges[:x]) for ranges, x in
+                       zip(self.ownership_ranges, mycoord)]
     def print_info(self):
-        '''Print out textual information of the cartesian topology'''
-        coords = self.topology.Get_coords(self.me.rank)
+        '''Print out textual information of the cartesian topology; the
+        ranks are those of the Cartesian communicator, which a plan or
+        reorder=True may have numbered differently from COMM_WORLD'''
+        rank = self.topology.Get_rank()
+        coords = self.topology.Get_coords(rank)
         msg="I am rank {rank} and I live at {coords}.".format(
-            rank=self.me.rank, coords=coords)
+            rank=rank, coords=coords)
         msg = msg + "Inverse lookup of {coords} gives rank {rank}.".format(
             coords=coords,rank=self.topology.Get_cart_rank(coords))
         serialised_print(msg, self.topology)
 directview["topology"]=topology
 
+class decomposition_plan(object):
+    '''Plan the decomposition of a global lattice over the ranks of a
+    communicator, taking the shape of the lattice and the nodes into
+    account.
+
+    MPI.Compute_dims only looks at the number of ranks, so a lattice of
+    e.g. 1024x64x64 points on 64 ranks gets cut into 256x16x16 blocks
+    with four times more halo than the 16x64x64 slabs. Instead, we try
+    every rank grid whose dimensions divide the lattice and pick the one
+    with the smallest total halo surface. If no rank grid divides the
+    lattice evenly, we pick the one with the smallest surface of the
+    largest blocks among all rank grids and spread the remainder over the
+    first ranks along each axis, giving uneven ownership ranges.
+
+    Then we map the ranks of each node onto a compact block of the rank
+    grid, picking the block shape with the smallest surface towards other
+    nodes, so that most halo traffic stays within the nodes. The nodes
+    are found with Split_type(COMM_TYPE_SHARED) unless "ranks_per_node"
+    is given, in which case ranks are assumed to be placed on the nodes
+    in consecutive blocks of that size. If the nodes have different
+    numbers of ranks, the placement is left to MPI.
+
+    Parameters
+    ----------
+    globalsizes : the number of lattice points along each axis (without
+                  ghost points)
+    periods : periodicity of each axis, as in rankinfo
+    comm : the communicator to decompose over
+    ranks_per_node : the number of ranks on each node; found out with
+                     Split_type if not given
+
+    Attributes
+    ----------
+    dims : dimensions of the rank grid
+    nodedims : dimensions of the block of the rank grid on each node
+    localsizes : the number of lattice points of this rank (without
+                 ghost points), to be passed to rankinfo
+    ownership_ranges : the number of lattice points of each rank along
+                       each axis if the lattice does not divide evenly,
+                       None if it does
+    comm : a communicator with the ranks in row-major Cartesian order,
+           to be used by topology
+    '''
+    def __init__(self, globalsizes, periods=None, comm=MPI.COMM_WORLD,
+                 ranks_per_node=None):
+        '''See above for details of initialisation.'''
+        ndim = len(globalsizes)
+        if (periods is None):
+            periods = [False]+[True]*(ndim-1)
+        candidates = [dims for dims in self.factorisations(comm.Get_size(), ndim)
+                      if all(n % d == 0 for n, d in zip(globalsizes, dims))]
+        self.ownership_ranges = None
+        if (len(candidates) == 0):
+            # uneven blocks, as long as every rank gets some of the lattice
+            candidates = [dims for dims
+                          in self.factorisations(comm.Get_size(), ndim)
+                          if all(n >= d for n, d in zip(globalsizes, dims))]
+            if (len(candidates) == 0):
+                raise ValueError("Cannot divide a lattice of {sizes} points "
+                                 "over {size} ranks".format(
+                                     sizes=list(globalsizes),
+                                     size=comm.Get_size()))
+        # ties go to the most even grid
+        self.dims = min(candidates, key=lambda dims: (
+            self.surface(self.blocksizes(globalsizes, dims), dims, periods)*
+            numpy.prod(dims), max(dims)))
+        if (any(n % d != 0 for n, d in zip(globalsizes, self.dims))):
+            self.ownership_ranges = [[n//d+(1 if x < n % d else 0)
+                                      for x in range(d)]
+                                     for n, d in zip(globalsizes, self.dims)]
+        blocksizes = self.blocksizes(globalsizes, self.dims)
+        node, noderank, nodesize = self.find_node(comm, ranks_per_node)
+        self.nodedims = None
+        if (nodesize is not None):
+            nodecandidates = [nodedims for nodedims
+                              in self.factorisations(nodesize, ndim)
+                              if all(d % n == 0 for d, n in zip(self.dims, nodedims))]
+            if (len(nodecandidates) > 0):
+                self.nodedims = min(nodecandidates, key=lambda nodedims: (
+                    # a periodic axis within one node costs no network traffic
+                    self.surface(numpy.multiply(nodedims, blocksizes),
+                                 numpy.divide(self.dims, nodedims),
+                                 [False]*ndim),
+                    max(nodedims)))
+        if (self.nodedims is None):
+            # leave the ranks in the order they are in
+            key = comm.Get_rank()
+        else:
+            nodegrid = [d//n for d, n in zip(self.dims, self.nodedims)]
+            coords = (numpy.multiply(numpy.unravel_index(node, nodegrid),
+                                     self.nodedims) +
+                      numpy.unravel_index(noderank, self.nodedims))
+            key = int(numpy.ravel_multi_index(tuple(coords), self.dims))
+        self.comm = comm.Split(0, key)
+        if (self.ownership_ranges is None):
+            self.localsizes = blocksizes
+        else:
+            mycoord = numpy.unravel_index(self.comm.Get_rank(), self.dims)
+            self.localsizes = [ranges[x] for ranges, x
+                               in zip(self.ownership_ranges, mycoord)]
+    def factorisations(self, size, ndim):
+        '''Return all the ordered ways of writing "size" as a product of
+        "ndim" factors.'''
+        if (ndim == 1):
+            return [[size]]
+        return [[factor]+rest for factor in range(1, size+1) if size % factor == 0
+                for rest in self.factorisations(size//factor, ndim-1)]
+    def blocksizes(self, globalsizes, dims):
+        '''Return the size of the largest block of a "dims" rank grid.'''
+        return [-(-n//d) for n, d in zip(globalsizes, dims)]
+    def surface(self, blocksizes, grid, periods):
+        '''Return the halo surface of one block of "blocksizes" points in a
+        "grid" of such blocks: only the faces which have a neighbouring
+        block count.'''
+        total = 0
+        for axis, (count, periodic) in enumerate(zip(grid, periods)):
+            if (count > 1 or periodic):
+                total += 2*numpy.prod(blocksizes)//blocksizes[axis]
+        return total
+    def find_node(self, comm, ranks_per_node):
+        '''Return the index of the node of this rank, the index of this rank
+        within its node and the number of ranks per node, which is None
+        if the nodes have different numbers of ranks.'''
+        rank, size = comm.Get_rank(), comm.Get_size()
+        if (ranks_per_node is not None):
+            if (size % ranks_per_node != 0):
+                return None, None, None
+            return rank//ranks_per_node, rank % ranks_per_node, ranks_per_node
+        nodecomm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        noderank, nodesize = nodecomm.Get_rank(), nodecomm.Get_size()
+        # number the nodes in the order of their lowest rank
+        leader = nodecomm.allreduce(rank, op=MPI.MIN)
+        nodecomm.Free()
+        leaders = sorted(set(comm.allgather(leader)))
+        if (len(set(comm.allgather(nodesize))) > 1):
+            return None, None, None
+        return leaders.index(leader), noderank, nodesize
+directview["decomposition_plan"]=decomposition_plan
+
 class ghost_data(object):
     '''Ghost communication manager object.
 
-    Basically consists of 12 MPI datatype instances describing the ghost
-    send/recv (2) communications in up/down (*2) the three (*3=12)
-    dimensions.
+    Basically consists of 4*ndim MPI datatype instances describing the
+    ghost send/recv (2) communications in up/down (*2) along each of the
+    ndim dimensions, i.e. 12 in 3D.
+
+    Stencils which reach the diagonal neighbours (e.g. 27-point or mixed
+    derivative stencils) also need the edge and corner ghosts: these are
+    exchanged when stencil="box". Either each of the 3**ndim-1 (26 in
+    3D) neighbours gets its own message (box_exchange="direct"), or the
+    faces are exchanged one axis at a time so that the corners travel
+    along with the faces (box_exchange="staged"): this needs only 2*ndim
+    messages, but the ndim stages have to happen one after the other.
+
+    With method="shared" the local arrays of the ranks on the same node
+    live in one MPI-3 shared memory window, so the ghosts from on-node
+    neighbours are just copied from their arrays and only the ones from
+    other nodes are sent as messages. The arrays must then be allocated
+    with allocate().
 
     Parameters
     ----------
     topology : a topology instance containing the desired cartesian
                communicator
     sizes : the size of the lattice on this rank (including ghost cells)
+    persistent : use persistent requests, see __init__
+    stencil : "star" for stencils which only reach along the axes, "box"
+              for ones reaching diagonal neighbours
+    box_exchange : "staged" or "direct", how to get the edges and corners
+                   for the "box" stencil
+    method : "p2p" for point-to-point messages, "neighbourhood" for MPI
+             neighbourhood collectives, "shared" for shared memory copies
+             within the nodes and point-to-point messages between them;
+             defaults to the environment variable GHOST_EXCHANGE, or "p2p"
+             if that is not set
 
     Attributes
     ----------
-    types : a dict of dicts of dicts containing instances of the 12
-            datatypes; outermost dict keys are axis names, next level
-            keys are "send" or "recv" and last level is direction "up"
-            or "down"   
-    axes : dict of dicts containing the neighbours along the axes; outer
-           dict is keyed with axis names, inner dict is keyed with
-           direction "up" or "down"
-    mx, my, mz : numbers of lattice points along the axes, including
-                 ghost points
+    types : a list of dicts of dicts containing instances of the
+            4*ndim datatypes; the list is indexed by the axis (as in
+            topology.shifts), dict keys are "send" or "recv" and last
+            level is direction "up" or "down"
+    axes : list of dicts containing the neighbours along the axes; the
+           dicts are keyed with direction "up" or "down"
+    stages : a list of stages of the ghost exchange, each of which is a
+             list of transfers; a transfer is a dict of the "send" and
+             "recv" datatypes, "dest" and "source" ranks, the "tag" and
+             the "sendregion" and "recvregion" slices the datatypes
+             describe; each stage has to finish before the next one can
+             start
+    method : the exchange method in use, "p2p", "neighbourhood" or
+             "shared"
+    stencil, box_exchange : the stencil and box exchange in use
+    neighbourhood : for each stage a dict of the "sendcounts",
+                    "recvcounts", "sendtypes" and "recvtypes" arguments
+                    of Neighbor_alltoallw when using "neighbourhood", and
+                    the point-to-point "transfers" of the axes whose two
+                    neighbours are the same rank
+    nodecomm : the communicator of the ranks on this node when using
+               "shared"
+    nodesizes : the sizes of the arrays of the ranks on this node when
+                using "shared"
+    shared : for each stage a dict of the "copies" from the arrays of the
+             ranks on this node, as (node rank, recvregion, sendregion)
+             tuples, and the point-to-point "transfers" to and from the
+             other nodes when using "shared"
+    windows : a dict of the shared memory windows allocated so far and
+              the arrays of all ranks of the node in them, keyed by the
+              address of the array of this rank
+    sizes : numbers of lattice points along the axes, including ghost
+            points
+    stencil_width : the depth of the ghost layer, taken from the
+                    rankinfo of "topology"
+    dtype : the numpy dtype of the lattice, taken from the rankinfo of
+            "topology"
+    mpitype : the MPI datatype matching dtype
+    persistent : whether ghost_exchange_start should (re)start persistent
+                 requests instead of creating new ones on every call
+    requests : a dict of the persistent requests created so far, keyed
+               by the address of the array they transfer
 
     Methods
     -------
-    None supposed to be called from outside the class.
+    persistent_requests : return the persistent requests of an array
+    free_requests : free all persistent requests
+    allocate : return a new local array suitable for the method
+    shared_copies : copy the ghosts of one stage from the ranks on this
+                    node
+    free_arrays : free the shared memory windows
 
     '''
-    def __init__(self, topology, sizes):
-        '''Use MPI.DOUBLE.Create_subarray to create the datatypes required for
-        ghost communications. We use MPI.DOUBLE as the underlying unit
-        datatype element as our data is of that type.
+    def __init__(self, topology, sizes, persistent=False, stencil="star",
+                 box_exchange="staged", method=None):
+        '''Use Create_subarray to create the datatypes required for ghost
+        communications. The underlying unit datatype element is the MPI
+        datatype matching the dtype of the lattice (from the rankinfo of
+        "topology"), e.g. MPI.DOUBLE for float64 and MPI.FLOAT for
+        float32.
 
         The call to Create_subarray() has three arguments
-            - the first, sizes, is the (local) size of the full 3D array
+            - the first, sizes, is the (local) size of the full array
               of elements of the basal type
             - the second argument is the size and shape of the subarray:
               this needs to be of the same dimension as the full array,
-              but one dimension can be just 1 grid point deep as we do
-              here, effectively making it one dimension lower
+              but one dimension can be just stencil_width grid points
+              deep as we do here, effectively making it one dimension
+              lower when stencil_width is 1
             - the third argument specifies the grid point where the
               subarray starts, in coordinates of the full local array
 
+        With persistent=True the transfers of each array are set up
+        only once, using Recv_init() and Send_init(), and subsequent
+        exchanges just restart them with Startall(). The per-step cost is
+        then independent of the Python overhead of creating requests,
+        which matters for the small lattices of strong scaling. Note that
+        the requests are bound to the memory of the array, so the array
+        must not be reallocated between exchanges.
+
+        With method="neighbourhood" the same subarray datatypes are handed
+        to a single Ineighbor_alltoallw() over the Cartesian communicator,
+        leaving it to the MPI library to schedule all the transfers of a
+        stage. Its neighbours come in the order lower and upper neighbour
+        along axis 0, then axis 1 and so on. A staged box exchange sets
+        the counts of the other axes to zero in each stage, but direct
+        diagonal messages are not possible as a Cartesian communicator
+        only knows its face neighbours. Persistent neighbourhood
+        collectives need MPI-4.
+
+        If the lower and upper neighbour along an axis are the same rank
+        (a periodic axis with one or two ranks) the collective may not
+        be able to tell the two transfers apart: not every MPI library
+        gets this right, so such axes are always exchanged point-to-point.
+
+        With method="shared" the ranks of the node are found with
+        Split_type(COMM_TYPE_SHARED). Transfers from a rank on the same
+        node become copies in shared_copies() and the rest stay
+        point-to-point messages, with PROC_NULL standing in for the ranks
+        on this node. Use a decomposition_plan to keep most neighbours on
+        the same node.
+
         '''
-        self.mz,self.my,self.mx = sizes
-        self.types = {}
-        self.axes = {}
-        for axis in ["X", "Y", "Z"]:
-            self.types[axis]={}
-            self.axes[axis]={}
+        if (method is None):
+            method = os.environ.get("GHOST_EXCHANGE", "p2p")
+        if (stencil not in ("star", "box")):
+            raise ValueError("Unknown stencil {stencil}".format(stencil=stencil))
+        if (box_exchange not in ("staged", "direct")):
+            raise ValueError("Unknown box exchange {method}".format(
+                method=box_exchange))
+        if (method not in ("p2p", "neighbourhood", "shared")):
+            raise ValueError("Unknown exchange method {method}".format(
+                method=method))
+        if (method == "neighbourhood" and stencil == "box" and
+            box_exchange == "direct"):
+            raise ValueError("Direct box exchange needs the p2p method")
+        if (method == "neighbourhood" and persistent and
+            MPI.Get_version() < (4, 0)):
+            raise ValueError("Persistent neighbourhood collectives need MPI-4")
+        self.method = method
+        self.stencil = stencil
+        self.box_exchange = box_exchange
+        self.persistent = persistent
+        self.requests = {}
+        self.windows = {}
+        self.stencil_width = topology.me.stencil_width
+        self.dtype = topology.me.dtype
+        self.mpitype = dtlib.from_numpy_dtype(self.dtype)
+        self.sizes = list(sizes)
+        ndim = len(self.sizes)
+        self.types = []
+        self.axes = []
+        for axis in range(ndim):
+            self.types.append({})
+            self.axes.append({})
             for op in ["send", "recv"]:
                 self.types[axis][op]={}
                 for movements in [("up","down"), ("down","up")]:
                     movement, negmovement = movements
-                    self.types[axis][op][movement] = MPI.DOUBLE.Create_subarray(
+                    self.types[axis][op][movement] = self.mpitype.Create_subarray(
                         sizes, self.get_plaq(axis),
                         self.get_corner(axis,op,movement))
                     self.types[axis][op][movement].Commit()
                     self.axes[axis][movement]={
                         "dest": topology.shifts[axis][movement],
                         "source": topology.shifts[axis][negmovement]}
+        faces = [[{"send": self.types[axis]["send"][direction],
+                   "recv": self.types[axis]["recv"][direction],
+                   "dest": self.axes[axis][direction]["dest"],
+                   "source": self.axes[axis][direction]["source"],
+                   "tag": tag,
+                   "sendregion": self.region_slices(
+                       self.get_plaq(axis),
+                       self.get_corner(axis, "send", direction)),
+                   "recvregion": self.region_slices(
+                       self.get_plaq(axis),
+                       self.get_corner(axis, "recv", direction))}
+                  for tag, direction in enumerate(["up", "down"])]
+                 for axis in range(ndim)]
+        # the X-like (last, fastest varying) axis goes first
+        if (stencil == "star"):
+            stage_axes = [list(reversed(range(ndim)))]
+        elif (box_exchange == "staged"):
+            stage_axes = [[axis] for axis in reversed(range(ndim))]
+        if (stencil == "box" and box_exchange == "direct"):
+            self.stages = [self.get_direct_transfers(topology, sizes)]
+        else:
+            self.stages = [sum([faces[axis] for axis in axes], [])
+                           for axes in stage_axes]
+        if (method == "neighbourhood"):
+            self.neighbourhood = [self.get_neighbourhood_stage(axes, faces)
+                                  for axes in stage_axes]
+        if (method == "shared"):
+            self.share_memory(topology, topology.topology.Split_type(
+                MPI.COMM_TYPE_SHARED))
     def axis2basisvec(self, axis):
-        return numpy.array([axis == "Z", axis == "Y", axis == "X"],
-                           dtype=numpy.float64)
+        vec = numpy.zeros(len(self.sizes), dtype=numpy.int64)
+        vec[axis] = 1
+        return vec
     def get_plaq(self, axis):
         vec = self.axis2basisvec(axis)
-        pl = [self.mz, self.my, self.mx]*(1-vec)+vec
+        pl = numpy.array(self.sizes)*(1-vec)+vec*self.stencil_width
         return list(pl)
     def get_corner(self, axis, sendrecv, movement):
+        '''Data moving "up" is sent from the topmost interior planes and
+        received into the bottom ghost planes of the neighbour, and vice
+        versa for "down".'''
         vec = self.axis2basisvec(axis)
-        axis_size = [x[0] for x in ((self.mx, "X"), (self.my, "Y"),
-                                    (self.mz, "Z")) if x[1]==axis][0]
-        loc = vec*( (movement=="down") +
-                    ((sendrecv=="send")*(movement=="up") or
-                     (sendrecv=="recv")*(movement=="down"))*(axis_size-2)
-        )
-        return list(loc)
+        axis_size = self.sizes[axis]
+        sw = self.stencil_width
+        start = {("send", "up"): axis_size-2*sw,
+                 ("send", "down"): sw,
+                 ("recv", "up"): 0,
+                 ("recv", "down"): axis_size-sw}[(sendrecv, movement)]
+        return list(vec*start)
+    def region_slices(self, plaq, corner):
+        return tuple(slice(start, start+n) for n, start in zip(plaq, corner))
+    def get_neighbour(self, topology, offset):
+        '''Return the rank at "offset" (in array axis order) from this rank in
+        the Cartesian topology, or MPI.PROC_NULL if there is none.'''
+        procsalong, periods, mycoord = topology.topology.Get_topo()
+        coords = []
+        for n, periodic, x in zip(procsalong, periods, numpy.add(mycoord, offset)):
+            if (periodic):
+                x = x % n
+            elif (x < 0 or x >= n):
+                return MPI.PROC_NULL
+            coords.append(int(x))
+        return topology.topology.Get_cart_rank(coords)
+    def get_region(self, offset, sendrecv):
+        '''Return the sizes and starts of the subarray which is sent
+        towards the neighbour at "offset" or received from the neighbour at
+        -offset. Unlike in get_plaq, the regions only cover the interior
+        along the axes where offset is 0, so that the face, edge and
+        corner regions do not overlap.'''
+        sw = self.stencil_width
+        plaq = []
+        corner = []
+        for n, o in zip(self.sizes, offset):
+            start = {("send", 1): n-2*sw, ("send", -1): sw,
+                     ("recv", 1): 0, ("recv", -1): n-sw}.get((sendrecv, o), sw)
+            plaq.append(sw if o else n-2*sw)
+            corner.append(start)
+        return plaq, corner
+    def get_direct_transfers(self, topology, sizes):
+        '''Create the transfers to and from all 3**ndim-1 neighbours.'''
+        transfers = []
+        offsets = [offset for offset in itertools.product([-1, 0, 1],
+                                                          repeat=len(sizes))
+                   if any(offset)]
+        for tag, offset in enumerate(offsets):
+            transfer = {"tag": tag,
+                        "dest": self.get_neighbour(topology, offset),
+                        "source": self.get_neighbour(topology,
+                                                     [-x for x in offset])}
+            for op in ["send", "recv"]:
+                transfer[op] = self.mpitype.Create_subarray(
+                    sizes, *self.get_region(offset, op))
+                transfer[op].Commit()
+                transfer[op+"region"] = self.region_slices(
+                    *self.get_region(offset, op))
+            transfers.append(transfer)
+        return transfers
+    def get_neighbourhood_stage(self, axes, faces):
+        '''Return the Neighbor_alltoallw arguments exchanging the ghosts
+        along "axes". We send "down" to and receive data moving "up" from
+        the lower neighbour, and the other way round for the upper one.'''
+        stage = {"sendcounts": [], "recvcounts": [],
+                 "sendtypes": [], "recvtypes": [], "transfers": []}
+        for axis in range(len(self.sizes)):
+            neighbours = self.axes[axis]
+            coincide = (neighbours["up"]["dest"] == neighbours["down"]["dest"]
+                        and neighbours["up"]["dest"] != MPI.PROC_NULL)
+            if (axis in axes and coincide):
+                stage["transfers"] += faces[axis]
+            for send, recv in [("down", "up"), ("up", "down")]:
+                stage["sendcounts"].append(int(axis in axes and not coincide))
+                stage["recvcounts"].append(int(axis in axes and not coincide))
+                stage["sendtypes"].append(self.types[axis]["send"][send])
+                stage["recvtypes"].append(self.types[axis]["recv"][recv])
+        return stage
+    def share_memory(self, topology, nodecomm):
+        '''Set up the copies between the ranks of "nodecomm", which must be
+        able to share memory, and the messages to the other ranks.'''
+        self.nodecomm = nodecomm
+        # with ownership ranges the neighbours' arrays and regions differ
+        # from ours
+        self.nodesizes = nodecomm.allgather(self.sizes)
+        sendregions = nodecomm.allgather(
+            [[transfer["sendregion"] for transfer in transfers]
+             for transfers in self.stages])
+        self.shared = [self.get_shared_stage(
+                           topology, transfers,
+                           [regions[stage] for regions in sendregions])
+                       for stage, transfers in enumerate(self.stages)]
+    def get_shared_stage(self, topology, transfers, sendregions):
+        '''Split the "transfers" of one stage into copies from the ranks
+        on this node and messages to and from the other nodes;
+        "sendregions" are the send regions of these transfers on each rank
+        of the node.'''
+        ranks = [transfer[end] for transfer in transfers
+                 for end in ["dest", "source"]]
+        noderanks = dict(zip(ranks, MPI.Group.Translate_ranks(
+            topology.topology.Get_group(), ranks, self.nodecomm.Get_group())))
+        def offnode(rank):
+            if (rank == MPI.PROC_NULL or noderanks[rank] == MPI.UNDEFINED):
+                return rank
+            return MPI.PROC_NULL
+        stage = {"copies": [], "transfers": []}
+        for n, transfer in enumerate(transfers):
+            if (offnode(transfer["source"]) == MPI.PROC_NULL and
+                transfer["source"] != MPI.PROC_NULL):
+                source = noderanks[transfer["source"]]
+                stage["copies"].append((source, transfer["recvregion"],
+                                        sendregions[source][n]))
+            message = dict(transfer, dest=offnode(transfer["dest"]),
+                           source=offnode(transfer["source"]))
+            if (message["dest"] != MPI.PROC_NULL or
+                message["source"] != MPI.PROC_NULL):
+                stage["transfers"].append(message)
+        return stage
+    def persistent_requests(self, topo, localarray):
+        '''Return the persistent requests transferring the ghosts of
+        "localarray", creating them on first use.
+
+        Parameters
+        ----------
+        topo : the communicator to use
+        localarray : the numpy array to read/write
+
+        Returns
+        -------
+        stages : a list of the lists of (inactive) persistent MPI requests
+                 of each stage
+        '''
+        address = localarray.__array_interface__["data"][0]
+        if (address not in self.requests):
+            # keep a reference to the array so that its memory stays valid
+            self.requests[address] = (localarray, [
+                stage_requests(topo, localarray, self, stage, persistent=True)
+                for stage in range(len(self.stages))])
+        return self.requests[address][1]
+    def free_requests(self):
+        '''Free all persistent requests created so far.'''
+        for localarray, stages in self.requests.values():
+            for commslist in stages:
+                for request in commslist:
+                    request.Free()
+        self.requests = {}
+    def allocate(self):
+        '''Return a new local array of zeros. With method="shared" it is
+        allocated in a new shared memory window of the node, so every rank
+        of the node has to call this the same number of times.'''
+        if (self.method != "shared"):
+            return numpy.zeros(self.sizes, dtype=self.dtype)
+        itemsize = self.dtype.itemsize
+        window = MPI.Win.Allocate_shared(int(numpy.prod(self.sizes))*itemsize,
+                                         itemsize, comm=self.nodecomm)
+        # we only ever synchronise with Sync() and the barriers
+        window.Lock_all(MPI.MODE_NOCHECK)
+        arrays = [numpy.ndarray(buffer=window.Shared_query(rank)[0],
+                                dtype=self.dtype, shape=sizes)
+                  for rank, sizes in enumerate(self.nodesizes)]
+        localarray = arrays[self.nodecomm.Get_rank()]
+        localarray[...] = 0
+        self.windows[localarray.__array_interface__["data"][0]] = (window,
+                                                                   arrays)
+        return localarray
+    def shared_copies(self, localarray, stage):
+        '''Copy the ghosts of "localarray" of one stage from the arrays of
+        the other ranks on this node, once they have all got this far.'''
+        address = localarray.__array_interface__["data"][0]
+        if (address not in self.windows):
+            raise ValueError("Shared ghost exchange needs an array from "
+                             "ghost_data.allocate()")
+        window, arrays = self.windows[address]
+        window.Sync()
+        self.nodecomm.Barrier()
+        window.Sync()
+        for source, recvregion, sendregion in self.shared[stage]["copies"]:
+            localarray[recvregion] = arrays[source][sendregion]
+    def free_arrays(self):
+        '''Free the shared memory windows allocated so far; free the
+        persistent requests using them first.'''
+        for window, arrays in self.windows.values():
+            window.Unlock_all()
+            window.Free()
+        self.windows = {}
 directview["ghost_data"]=ghost_data
 
+def ghost_requests(recv, send, localarray, transfers):
+    '''Create the requests of the ghost transfers of "localarray".
+
+    Parameters
+    ----------
+    recv, send : the communicator methods used to create the requests,
+                 e.g. Irecv and Isend or Recv_init and Send_init
+    localarray : the numpy array to read/write
+    transfers : a list of transfers, i.e. one stage of ghost_data.stages
+
+    Returns
+    -------
+    commslist : a list of the MPI requests; receives come first
+    '''
+    commslist=[]
+    for transfer in transfers:
+        commslist.append(
+            recv(buf=[localarray, 1, transfer["recv"]],
+                 source=transfer["source"], tag=transfer["tag"]))
+    for transfer in transfers:
+        commslist.append(
+            send(buf=[localarray, 1, transfer["send"]],
+                 dest=transfer["dest"], tag=transfer["tag"]))
+    return commslist
+directview["ghost_requests"]=ghost_requests
+
+def neighbourhood_request(collective, localarray, stage):
+    '''Create the neighbourhood collective request of one stage.
+
+    Parameters
+    ----------
+    collective : the communicator method used to create the request,
+                 e.g. Ineighbor_alltoallw or Neighbor_alltoallw_init
+    localarray : the numpy array to read/write
+    stage : one stage of ghost_data.neighbourhood
+
+    Returns
+    -------
+    request : the MPI request of the collective
+    '''
+    # the datatypes locate the ghosts, so every displacement is zero
+    displs = [0]*len(stage["sendtypes"])
+    return collective(
+        [localarray, (stage["sendcounts"], displs), stage["sendtypes"]],
+        [localarray, (stage["recvcounts"], displs), stage["recvtypes"]])
+directview["neighbourhood_request"]=neighbourhood_request
+
+def stage_requests(topo, localarray, ghostdefs, stage, persistent=False):
+    '''Create the requests of one stage of the ghost exchange using the
+    method chosen in "ghostdefs".
+
+    Parameters
+    ----------
+    topo : the communicator to use
+    localarray : the numpy array to read/write
+    ghostdefs : an instance of ghost_data of this particular lattice and
+                topology
+    stage : the index of the stage in ghostdefs.stages
+    persistent : create persistent (inactive) requests instead of starting
+                 the transfers
+
+    Returns
+    -------
+    commslist : a list of the MPI requests of the stage
+    '''
+    comm = topo.topology
+    if (ghostdefs.method == "neighbourhood"):
+        if (persistent):
+            collective = comm.Neighbor_alltoallw_init
+        else:
+            collective = comm.Ineighbor_alltoallw
+        transfers = ghostdefs.neighbourhood[stage]["transfers"]
+        commslist = [neighbourhood_request(collective, localarray,
+                                           ghostdefs.neighbourhood[stage])]
+    elif (ghostdefs.method == "shared"):
+        transfers = ghostdefs.shared[stage]["transfers"]
+        commslist = []
+    else:
+        transfers = ghostdefs.stages[stage]
+        commslist = []
+    if (persistent):
+        recv, send = comm.Recv_init, comm.Send_init
+    else:
+        recv, send = comm.Irecv, comm.Isend
+    return commslist + ghost_requests(recv, send, localarray, transfers)
+directview["stage_requests"]=stage_requests
+
 def ghost_exchange_start(topo, localarray, ghostdefs):
     '''Start sending and receiving the ghost data.
 
+    If the exchange has several stages, all but the last one are
+    completed here, so only the last one can overlap with computation.
+    With the "shared" method the copies from the ranks on this node are
+    done here, too, and the returned requests include a barrier of the
+    node so that no rank changes its array before its neighbours have
+    copied their ghosts.
+
     Parameters
     ----------
     topo : the communicator to use
@@ -265,23 +1022,20 @@ def ghost_exchange_start(topo, localarray, ghostdefs):
     commslist : a list of the MPI communication objects that control the
                 transfers we started
     '''    
-    commslist=[]
-    for axis in ["X", "Y", "Z"]:
-        for direction in ["up", "down"]:
-            commslist.append(
-                topo.topology.Irecv(
-                    buf=[localarray, 1,
-                         ghostdefs.types[axis]["recv"][direction]],
-                    source=ghostdefs.axes[axis][direction]["source"],
-                    tag=0))
-    for axis in ["X", "Y", "Z"]:
-        for direction in ["up", "down"]:
-            commslist.append(
-                topo.topology.Isend(
-                    buf=[localarray, 1,
-                         ghostdefs.types[axis]["send"][direction]],
-                    dest=ghostdefs.axes[axis][direction]["dest"],
-                    tag=0))
+    if (ghostdefs.persistent):
+        stages = ghostdefs.persistent_requests(topo, localarray)
+    for stage in range(len(ghostdefs.stages)):
+        if (ghostdefs.persistent):
+            commslist = stages[stage]
+            MPI.Prequest.Startall(commslist)
+        else:
+            commslist = stage_requests(topo, localarray, ghostdefs, stage)
+        if (ghostdefs.method == "shared"):
+            ghostdefs.shared_copies(localarray, stage)
+        if (stage < len(ghostdefs.stages)-1):
+            ghost_exchange_finish(commslist)
+    if (ghostdefs.method == "shared"):
+        commslist = commslist + [ghostdefs.nodecomm.Ibarrier()]
     return commslist
 directview["ghost_exchange_start"]=ghost_exchange_start
 
@@ -296,7 +1050,36 @@ def ghost_exchange_finish(commslist):
     return
 directview["ghost_exchange_finish"]=ghost_exchange_finish
 
-def initialise_values(me, topo):
+def squared_index(coords, globalsizes):
+    '''The default initial values: the square of the row-major index of
+    each point in the global lattice.
+
+    This is also the interface of the initialisers of initialise_values:
+    "coords" is a list of the global coordinates along each axis, shaped
+    for broadcasting like numpy.ogrid gives them (i.e. coords[a] has
+    length 1 along every axis except a), and the return value must
+    broadcast to the shape of the local interior. Writing the initialiser
+    as a numpy expression of "coords" keeps it vectorised.
+
+    Parameters
+    ----------
+    coords : the global coordinates of the local interior points along
+             each axis, as open grids
+    globalsizes : the number of lattice points of the global lattice
+                  along each axis (without ghost points)
+
+    Return
+    ------
+    values : the initial values at the points of "coords"
+    '''
+    # strides of the row-major global lattice, e.g. [Gy*Gx, Gx, 1] in 3D
+    strides = numpy.cumprod([1]+list(globalsizes[:0:-1]))[::-1]
+    index = sum(x*stride for x, stride in zip(coords, strides))
+    # square in floating point: the index squared overflows int64 easily
+    return numpy.asarray(index, dtype=numpy.float64)**2
+directview["squared_index"]=squared_index
+
+def initialise_values(me, topo, initialiser=squared_index, ghostdefs=None):
     '''Set up the initial values in the lattice; never mind the details,
        they are "problem" dependent anyway.
 
@@ -305,53 +1088,171 @@ def initialise_values(me, topo):
     me : an instance of rankinfo
     topo : an instance of topology; should be the same Cartesian
            topology we create earlier using "me"
+    initialiser : a function of the global coordinates giving the initial
+                  values, see squared_index
+    ghostdefs : the ghost_data instance the array will be used with, to
+                allocate the array in the way its method needs
 
     Return
     ------
     local_array : the local portion of the global data as initialised
                   (with ghost points, but ghosts are uninitialised)
     '''
-    size = topo.topology.Get_size()
-    local_array = numpy.zeros(me.localsizes)
-    procsalong, periods, mycoord = topo.topology.Get_topo()
-    mycorner = mycoord*(numpy.array(me.localsizes)-2)
-    sz, sy, sx = numpy.array(me.localsizes)-2
-    for z in range(sz):
-        for y in range(sy):
-            start = (mycorner[2] + sx*(y+mycorner[1])*procsalong[2] +
-                     sy*sx*(z+mycorner[0])*procsalong[2]*procsalong[1])
-            stop = start + sx
-            local_array[z+1,y+1,1:-1] = numpy.arange(start,
-                                                     stop, step=1)**2
+    sw = me.stencil_width
+    if (ghostdefs is None):
+        local_array = numpy.zeros(me.localsizes, dtype=me.dtype)
+    else:
+        local_array = ghostdefs.allocate()
+    interior = numpy.array(me.localsizes)-2*sw
+    # like numpy.ogrid, but that does not return a list in 1D
+    coords = [numpy.arange(start, start+n).reshape(
+                  [-1 if axis == other else 1 for other in range(len(interior))])
+              for axis, (start, n) in enumerate(zip(topo.corner, interior))]
+    local_array[(slice(sw,-sw),)*local_array.ndim] = initialiser(
+        coords, topo.globalsizes)
     return local_array
 directview["initialise_values"]=initialise_values
 
 
-def compute_grad(topology, local_array, ghostdefs):
+def gradient_region(local_array, gradients, lower, upper, sw=1):
+    '''Compute the 2nd order central finite difference gradient of
+    "local_array" for the points in the box [lower, upper) and store it
+    in the corresponding points of "gradients".
+
+    The box is given in the coordinates of the ghosted "local_array",
+    while "gradients" only covers the interior points, i.e. it is offset
+    by "sw" points along every axis. Empty boxes are silently ignored.
+
+    Parameters
+    ----------
+    local_array : the local portion of the global lattice, including
+                  ghost points
+    gradients : the (ndim, nz, ny, nx) output array for the interior points
+                (or with however many axes the lattice has)
+    lower, upper : the corners of the box to compute, in array axis order
+    sw : the stencil width, i.e. the depth of the ghost layer
+    '''
+    if any(lo >= up for lo, up in zip(lower, upper)):
+        return
+    target = tuple(slice(lo-sw, up-sw) for lo, up in zip(lower, upper))
+    for axis in range(len(lower)):
+        below = [slice(lo, up) for lo, up in zip(lower, upper)]
+        above = list(below)
+        below[axis] = slice(lower[axis]-1, upper[axis]-1)
+        above[axis] = slice(lower[axis]+1, upper[axis]+1)
+        numpy.subtract(local_array[tuple(above)], local_array[tuple(below)],
+                       out=gradients[(axis,)+target])
+        gradients[(axis,)+target] *= 0.5
+    return
+directview["gradient_region"]=gradient_region
+
+def compute_grad(topology, local_array, ghostdefs, overlap=False):
     '''Compute the 2nd order central finite difference gradient of the
     data.
 
+    With overlap=True the interior gradient, i.e. the points whose
+    stencil does not reach the ghost points, is computed while the ghost
+    transfers are in flight. Once they have finished, only the one point
+    thick shell next to the ghost points is left to do. The shell is cut
+    into 2*ndim non-overlapping slabs: in 3D the two slabs normal to Z
+    (axis 0) take the full extent in Y and X, the Y slabs leave out the Z
+    shell points and the X slabs leave out both.
+
     Parameters
     ----------
     topology : an instance of the relevan Cartesian topology
     local_array : the local portion of the global lattice, including
                   ghost points
     ghostdefs : the ghost data communication objects
+    overlap : overlap the interior computation with the ghost exchange
 
     Return
     ------
-    gradients : the gradient of the interior points of "local_array";
-                note that numpy.gradient will compute values at the
-                ghost points, too, but those are not included in
-                "gradients" (note the slice)
+    gradients : an array of shape (ndim,)+interior shape holding the
+                components of the gradient (along axis 0, 1, ...) at the
+                interior points of "local_array", i.e. without the ghost
+                points; without overlap numpy.gradient computes them on
+                the whole array, ghost points included, and the ghost
+                points are sliced off, while with overlap gradient_region
+                fills them in place region by region, giving the same
+                central differences
     '''
+    sw = ghostdefs.stencil_width
     commslist=ghost_exchange_start(topology, local_array, ghostdefs)
-    # could do work here but NOT use ghost points!
+    if (not overlap):
+        # could do work here but NOT use ghost points!
+        ghost_exchange_finish(commslist)
+        # in 1D numpy.gradient returns an array instead of a list of them
+        gradients=numpy.array(numpy.gradient(local_array)).reshape(
+            (local_array.ndim,)+local_array.shape)
+        return gradients[(slice(None),)+(slice(sw,-sw),)*local_array.ndim]
+    shape = local_array.shape
+    gradients = numpy.empty((len(shape),)+tuple(x-2*sw for x in shape),
+                            dtype=local_array.dtype)
+    gradient_region(local_array, gradients,
+                    [sw+1]*len(shape), [x-sw-1 for x in shape], sw)
     ghost_exchange_finish(commslist)
-    gradients=numpy.array(numpy.gradient(local_array))[:,1:-1,1:-1,1:-1]
+    for axis in range(len(shape)):
+        lower = [sw+1]*axis + [sw]*(len(shape)-axis)
+        upper = ([x-sw-1 for x in shape[:axis]] +
+                 [x-sw for x in shape[axis:]])
+        # a single interior point is both the lower and upper side
+        for side in sorted(set([sw, shape[axis]-sw-1])):
+            lower[axis], upper[axis] = side, side+1
+            gradient_region(local_array, gradients, lower, upper, sw)
     return gradients
 directview["compute_grad"]=compute_grad
 
+def diffusion_steps(local_array, ghostdefs, steps, nu=0.1):
+    '''Take "steps" explicit diffusion steps
+
+        u <- u + nu * (discrete Laplacian of u)
+
+    without exchanging ghosts in between. Each step invalidates one more
+    layer of ghost points, so the region that is updated shrinks by one
+    point per step on every side where the ghosts come from a neighbour;
+    after "steps" steps the interior is exactly what it would be with a
+    ghost exchange before every step, provided steps <= stencil_width
+    and the edge and corner ghosts have been exchanged, too (see
+    ghost_data with stencil="box").
+    The price is the redundant computation in the ghost layer. Ghost
+    points on non-periodic boundaries (no neighbour) hold the boundary
+    condition and are never updated.
+
+    Parameters
+    ----------
+    local_array : the local portion of the global lattice, with freshly
+                  exchanged ghost points; updated in place
+    ghostdefs : the ghost data communication objects of "local_array"
+    steps : number of steps to take, at most the stencil width
+    nu : the diffusion coefficient times the time step over the square
+         of the lattice spacing; nu <= 1/(2*ndim) for stability
+    '''
+    sw = ghostdefs.stencil_width
+    if (steps > sw):
+        raise ValueError("Cannot take {steps} steps with a ghost layer only "
+                         "{sw} points deep.".format(steps=steps, sw=sw))
+    shape = local_array.shape
+    # the neighbour "source" of data moving "up" fills the lower ghosts
+    exchanged = [(ghostdefs.axes[axis]["up"]["source"] != MPI.PROC_NULL,
+                  ghostdefs.axes[axis]["down"]["source"] != MPI.PROC_NULL)
+                 for axis in range(len(shape))]
+    new_array = numpy.empty_like(local_array)
+    for step in range(1, steps+1):
+        region = [slice(step if low else sw, n-step if high else n-sw)
+                  for n, (low, high) in zip(shape, exchanged)]
+        new_array[tuple(region)] = local_array[tuple(region)]*(1-2*len(shape)*nu)
+        for axis in range(len(shape)):
+            below = list(region)
+            above = list(region)
+            below[axis] = slice(region[axis].start-1, region[axis].stop-1)
+            above[axis] = slice(region[axis].start+1, region[axis].stop+1)
+            new_array[tuple(region)] += nu*(local_array[tuple(below)] +
+                                            local_array[tuple(above)])
+        local_array[tuple(region)] = new_array[tuple(region)]
+    return
+directview["diffusion_steps"]=diffusion_steps
+
 def find_global_max(topology, local_array, ghostdefs):
     '''Find the global maximum value on the lattice.  We first use the
     .max() method to find the local maximum Then use Allreduce to apply
@@ -372,7 +1273,8 @@ def find_global_max(topology, local_array, ghostdefs):
     maxgrad_local,maxgrad_global : local and global maximum on the
                                    lattice
     '''
-    maxgrad_local = numpy.array(local_array).max()
+    maxgrad_local = numpy.array(numpy.array(local_array).max(),
+                                dtype=numpy.float64)
     maxgrad_global = numpy.zeros_like(maxgrad_local)
     topology.topology.Allreduce([maxgrad_local, MPI.DOUBLE],
                                 [maxgrad_global, MPI.DOUBLE],
@@ -380,9 +1282,729 @@ def find_global_max(topology, local_array, ghostdefs):
     return maxgrad_local, maxgrad_global
 directview["find_global_max"]=find_global_max
 
+def gradient_blockshape(shape, itemsize, cache_bytes=262144):
+    '''Choose the shape of the blocks max_gradient streams over: whole
+    rows along the last (contiguous) axis, and as many of them along the
+    preceding axes as fit in "cache_bytes".
+
+    Parameters
+    ----------
+    shape : the shape of the interior of the lattice
+    itemsize : the size of an element in bytes
+    cache_bytes : the size of the block to aim for, e.g. the L2 cache
+
+    Return
+    ------
+    blockshape : a list of the block size along each axis
+    '''
+    blockshape = [1]*len(shape)
+    blockshape[-1] = shape[-1]
+    room = max(1, cache_bytes//(itemsize*shape[-1]))
+    for axis in reversed(range(len(shape)-1)):
+        blockshape[axis] = max(1, min(shape[axis], room))
+        room = max(1, room//shape[axis])
+    return blockshape
+directview["gradient_blockshape"]=gradient_blockshape
+
+def max_gradient(local_array, sw=1, blockshape=None):
+    '''Find the maximum of all components of the 2nd order central
+    finite difference gradient over the interior of "local_array",
+    without ever storing the whole gradient.
+
+    The interior is processed in blocks of "blockshape" points: the
+    differences along each axis go into a single preallocated block
+    sized buffer and only a running maximum is kept, so the memory use
+    is O(block) instead of ndim times the size of the lattice, and the
+    block stays in cache between the subtraction and the max(). Halving
+    the differences is left until the end, which is exact.
+
+    Parameters
+    ----------
+    local_array : the local portion of the global lattice, with
+                  exchanged ghost points
+    sw : the stencil width, i.e. the depth of the ghost layer
+    blockshape : the size of the blocks along each axis; by default
+                 chosen by gradient_blockshape
+
+    Return
+    ------
+    maxgrad : the maximum gradient component on the local interior
+    '''
+    interior = [x-2*sw for x in local_array.shape]
+    if (blockshape is None):
+        blockshape = gradient_blockshape(interior, local_array.itemsize)
+    buffer = numpy.empty(blockshape, dtype=local_array.dtype)
+    maxdiff = -numpy.inf
+    for corner in itertools.product(*[range(sw, sw+n, b)
+                                      for n, b in zip(interior, blockshape)]):
+        block = [slice(c, min(c+b, sw+n))
+                 for c, b, n in zip(corner, blockshape, interior)]
+        out = buffer[tuple(slice(0, x.stop-x.start) for x in block)]
+        for axis in range(local_array.ndim):
+            below = list(block)
+            above = list(block)
+            below[axis] = slice(block[axis].start-1, block[axis].stop-1)
+            above[axis] = slice(block[axis].start+1, block[axis].stop+1)
+            numpy.subtract(local_array[tuple(above)],
+                           local_array[tuple(below)], out=out)
+            maxdiff = max(maxdiff, out.max())
+    # the maximum is exact in any precision, only the result is float64
+    return numpy.array(0.5*float(maxdiff))
+directview["max_gradient"]=max_gradient
+
+def find_global_max_grad(topology, local_array, ghostdefs, blockshape=None,
+                         timer=None):
+    '''Exchange the ghosts and find the global maximum of the gradient
+    in one go, using the fused kernel max_gradient: unlike compute_grad
+    followed by find_global_max, the gradient is never stored.
+
+    Parameters
+    ----------
+    topology : an instance of the relevant Cartesian topology
+    local_array : the local portion of the global lattice, including
+                  ghost points
+    ghostdefs : the ghost transfer objects
+    blockshape : passed on to max_gradient
+    timer : an optional phase_timer to record the phases in
+
+    Returns
+    -------
+    maxgrad_local,maxgrad_global : local and global maximum gradient on
+                                   the lattice
+    '''
+    if (timer is not None):
+        timer.lap("idle")
+    commslist = ghost_exchange_start(topology, local_array, ghostdefs)
+    if (timer is not None):
+        timer.lap("post")
+    ghost_exchange_finish(commslist)
+    if (timer is not None):
+        timer.lap("wait")
+    maxgrad_local = max_gradient(local_array, ghostdefs.stencil_width,
+                                 blockshape)
+    if (timer is not None):
+        timer.lap("compute")
+    maxgrad_global = numpy.zeros_like(maxgrad_local)
+    topology.topology.Allreduce([maxgrad_local, MPI.DOUBLE],
+                                [maxgrad_global, MPI.DOUBLE],
+                                op=MPI.MAX)
+    if (timer is not None):
+        timer.lap("reduce")
+    return maxgrad_local, maxgrad_global
+directview["find_global_max_grad"]=find_global_max_grad
+
+class statistics_reduction(object):
+    '''Several global statistics of the lattice data in one collective.
+
+    The local values of all the requested statistics are packed into a
+    single buffer of doubles and reduced with one Allreduce (or an
+    Iallreduce, which can overlap with the next step). Since there is
+    only one reduction operation per collective, a user defined MPI
+    operation combines each slot of the buffer in its own way. The
+    buffer is sent as a single element of a contiguous datatype, so the
+    operation always sees whole records.
+
+    The statistics are
+        - "max", "min" : the extreme values
+        - "sum", "sumsq" : the sum and the sum of squares, accumulated
+                           in float64
+        - "argmax" : the maximum and the global coordinates of (the
+                     first, in row-major order) point where it occurs;
+                     this takes two slots, the value and the flat index
+
+    Parameters
+    ----------
+    statistics : a sequence of the names of the statistics to compute
+
+    Attributes
+    ----------
+    statistics : the statistics to compute
+    slots : a dict of the index of the first slot of each statistic in
+            the buffer
+    length : the number of doubles in the buffer
+    datatype : the MPI datatype of the whole buffer
+    op : the MPI operation combining two buffers
+
+    '''
+    widths = {"max": 1, "min": 1, "sum": 1, "sumsq": 1, "argmax": 2}
+    def __init__(self, statistics=("max", "min", "sum", "sumsq", "argmax")):
+        '''See above for details of initialisation.'''
+        for statistic in statistics:
+            if (statistic not in self.widths):
+                raise ValueError("Unknown statistic {statistic}".format(
+                    statistic=statistic))
+        self.statistics = list(statistics)
+        self.slots = {}
+        length = 0
+        for statistic in self.statistics:
+            self.slots[statistic] = length
+            length += self.widths[statistic]
+        self.length = length
+        self.datatype = MPI.DOUBLE.Create_contiguous(length)
+        self.datatype.Commit()
+        self.op = MPI.Op.Create(self.combine, commute=True)
+    def combine(self, inbuf, inoutbuf, datatype):
+        '''The MPI operation: combine the records in "inbuf" into the ones
+        in "inoutbuf", slot by slot.'''
+        new = numpy.frombuffer(inbuf, dtype=numpy.float64).reshape(-1, self.length)
+        old = numpy.frombuffer(inoutbuf, dtype=numpy.float64).reshape(-1, self.length)
+        for statistic, slot in self.slots.items():
+            if (statistic == "max"):
+                numpy.maximum(old[:,slot], new[:,slot], out=old[:,slot])
+            elif (statistic == "min"):
+                numpy.minimum(old[:,slot], new[:,slot], out=old[:,slot])
+            elif (statistic in ("sum", "sumsq")):
+                old[:,slot] += new[:,slot]
+            else:
+                # bigger value wins, ties go to the smaller index
+                take = ((new[:,slot] > old[:,slot]) |
+                        ((new[:,slot] == old[:,slot]) &
+                         (new[:,slot+1] < old[:,slot+1])))
+                old[take,slot:slot+2] = new[take,slot:slot+2]
+        return
+    def pack(self, local_array, corner, globalshape):
+        '''Compute the local statistics of "local_array" into a buffer.
+
+        Parameters
+        ----------
+        local_array : the local data, without ghost points
+        corner : the global coordinates of local_array[0,0,...]
+        globalshape : the shape of the global lattice
+
+        Return
+        ------
+        buffer : the local statistics, ready to be reduced
+        '''
+        buffer = numpy.empty(self.length, dtype=numpy.float64)
+        empty = (local_array.size == 0)
+        for statistic, slot in self.slots.items():
+            if (statistic == "max"):
+                buffer[slot] = -numpy.inf if empty else local_array.max()
+            elif (statistic == "min"):
+                buffer[slot] = numpy.inf if empty else local_array.min()
+            elif (statistic == "sum"):
+                buffer[slot] = local_array.sum(dtype=numpy.float64)
+            elif (statistic == "sumsq"):
+                buffer[slot] = numpy.square(local_array, dtype=numpy.float64).sum()
+            elif (empty):
+                buffer[slot:slot+2] = -numpy.inf, -1
+            else:
+                where = numpy.unravel_index(local_array.argmax(),
+                                            local_array.shape)
+                buffer[slot] = local_array[where]
+                buffer[slot+1] = numpy.ravel_multi_index(
+                    tuple(numpy.add(where, corner)), globalshape)
+        return buffer
+    def unpack(self, buffer, globalshape):
+        '''Turn a reduced buffer into a dict of the statistics; "argmax"
+        becomes a tuple of the maximum and its global coordinates.'''
+        result = {}
+        for statistic, slot in self.slots.items():
+            if (statistic == "argmax"):
+                location = (tuple(int(x) for x in numpy.unravel_index(
+                    int(buffer[slot+1]), globalshape))
+                            if buffer[slot+1] >= 0 else None)
+                result[statistic] = (buffer[slot], location)
+            else:
+                result[statistic] = buffer[slot]
+        return result
+    def reduce(self, comm, local_array, corner, globalshape, nonblocking=False):
+        '''Reduce the statistics of "local_array" over "comm".
+
+        Parameters
+        ----------
+        comm : the communicator to reduce over
+        local_array, corner, globalshape : see pack
+        nonblocking : use Iallreduce and return at once
+
+        Return
+        ------
+        result : the dict of the global statistics; with nonblocking=True
+                 a pending_statistics instance whose wait() returns it
+        '''
+        sendbuf = self.pack(local_array, corner, globalshape)
+        recvbuf = numpy.empty_like(sendbuf)
+        if (nonblocking):
+            request = comm.Iallreduce([sendbuf, 1, self.datatype],
+                                      [recvbuf, 1, self.datatype], op=self.op)
+            return pending_statistics(self, request, sendbuf, recvbuf,
+                                      globalshape)
+        comm.Allreduce([sendbuf, 1, self.datatype],
+                       [recvbuf, 1, self.datatype], op=self.op)
+        return self.unpack(recvbuf, globalshape)
+    def free(self):
+        '''Free the MPI datatype and operation.'''
+        self.datatype.Free()
+        self.op.Free()
+directview["statistics_reduction"]=statistics_reduction
+
+class pending_statistics(object):
+    '''A statistics_reduction in flight, see statistics_reduction.reduce.
+
+    Methods
+    -------
+    test : return True if the reduction has finished
+    wait : wait for the reduction to finish and return the statistics
+    '''
+    def __init__(self, reduction, request, sendbuf, recvbuf, globalshape):
+        '''Keep the buffers alive until the request has finished.'''
+        self.reduction = reduction
+        self.request = request
+        self.sendbuf = sendbuf
+        self.recvbuf = recvbuf
+        self.globalshape = globalshape
+    def test(self):
+        return self.request.Test()
+    def wait(self):
+        self.request.Wait()
+        return self.reduction.unpack(self.recvbuf, self.globalshape)
+directview["pending_statistics"]=pending_statistics
+
+def reduce_statistics(topology, local_array, reduction, nonblocking=False):
+    '''Reduce the statistics of "reduction" over the interior of the
+    lattice "local_array" in a single collective.
+
+    Parameters
+    ----------
+    topology : an instance of the relevant Cartesian topology
+    local_array : the local portion of the global lattice, including
+                  ghost points
+    reduction : an instance of statistics_reduction
+    nonblocking : return a pending_statistics at once instead of waiting
+
+    Returns
+    -------
+    result : a dict of the global statistics, see statistics_reduction
+    '''
+    sw = topology.me.stencil_width
+    interior = local_array[(slice(sw,-sw),)*local_array.ndim]
+    return reduction.reduce(topology.topology, interior, topology.corner,
+                            tuple(topology.globalsizes),
+                            nonblocking=nonblocking)
+directview["reduce_statistics"]=reduce_statistics
+
+class phase_timer(object):
+    '''Per-phase wall clock timing of each rank.
+
+    The phases are
+        - "post" : posting the ghost transfers (ghost_exchange_start)
+        - "wait" : waiting for them to finish (ghost_exchange_finish),
+                   i.e. halo stalls and load imbalance of the neighbours
+        - "compute" : the stencil kernels
+        - "reduce" : global reductions
+        - "idle" : anything else between the phases, e.g. callbacks
+
+    lap(phase) adds the time since the previous lap to "phase". Only the
+    last "capacity" laps of each phase are kept, in preallocated ring
+    buffers, but the totals and counts cover all of them, so a lap costs
+    a call to MPI.Wtime() and a couple of numpy element assignments.
+    summary() aggregates over the ranks at the end.
+
+    Parameters
+    ----------
+    capacity : the number of laps of each phase to keep
+
+    Attributes
+    ----------
+    samples : an array of the last laps of each phase (one row per phase)
+    counts : the number of laps of each phase so far
+    totals : the total time of each phase so far
+    last : the time of the previous lap
+
+    Methods
+    -------
+    reset : start timing from now, forgetting the laps so far
+    lap : add the time since the previous lap to a phase
+    summary : aggregate the timings over the ranks
+    export_json : write the summary into a JSON file
+    '''
+    phases = ("post", "wait", "compute", "reduce", "idle")
+    def __init__(self, capacity=1024):
+        '''See above for details of initialisation.'''
+        self.capacity = capacity
+        self.index = dict((phase, n) for n, phase in enumerate(self.phases))
+        self.samples = numpy.zeros((len(self.phases), capacity))
+        self.counts = numpy.zeros(len(self.phases), dtype=numpy.int64)
+        self.totals = numpy.zeros(len(self.phases))
+        self.reset()
+    def reset(self):
+        self.samples[...] = 0
+        self.counts[...] = 0
+        self.totals[...] = 0
+        self.last = MPI.Wtime()
+    def lap(self, phase):
+        now = MPI.Wtime()
+        elapsed = now-self.last
+        n = self.index[phase]
+        self.samples[n, self.counts[n] % self.capacity] = elapsed
+        self.counts[n] += 1
+        self.totals[n] += elapsed
+        self.last = now
+        return elapsed
+    def summary(self, comm):
+        '''Return a dict with the minimum, mean and maximum over the
+        ranks of "comm" of the total time of each phase, its imbalance
+        (maximum over mean) and the median and maximum of the recent laps
+        on the slowest rank, the one with the largest total for that
+        phase. Collective.'''
+        local = numpy.empty((3, len(self.phases)))
+        local[0] = self.totals
+        for n in range(len(self.phases)):
+            recent = self.samples[n, :min(self.counts[n], self.capacity)]
+            local[1, n] = numpy.median(recent) if len(recent) else 0
+            local[2, n] = recent.max() if len(recent) else 0
+        ranks = numpy.empty((comm.Get_size(),)+local.shape)
+        comm.Allgather(local, ranks)
+        minimum = ranks.min(axis=0)
+        maximum = ranks.max(axis=0)
+        mean = ranks.mean(axis=0)
+        slowest = ranks[:, 0].argmax(axis=0)
+        result = {"ranks": comm.Get_size(), "phases": {}}
+        for phase, n in self.index.items():
+            result["phases"][phase] = {
+                "laps": int(self.counts[n]),
+                "min": float(minimum[0, n]), "mean": float(mean[0, n]),
+                "max": float(maximum[0, n]),
+                "imbalance": float(maximum[0, n]/mean[0, n]) if mean[0, n] > 0
+                             else 1.0,
+                "slowest_rank": int(slowest[n]),
+                "median_lap": float(ranks[slowest[n], 1, n]),
+                "max_lap": float(ranks[slowest[n], 2, n])}
+        return result
+    def export_json(self, comm, filename):
+        '''Write the summary into "filename" from the first rank and return
+        it. Collective.'''
+        result = self.summary(comm)
+        if (comm.Get_rank() == 0):
+            with open(filename, "w") as output:
+                json.dump(result, output, indent=2)
+        return result
+directview["phase_timer"]=phase_timer
+
+def diffusion_kernel(source, target, ghostdefs, nu=0.1):
+    '''A stepper kernel: one explicit diffusion step u += nu*Laplacian(u)
+    from "source" into the interior of "target". The step is written as
+    nu*(sum of neighbours + (1/nu-2*ndim)*u) and accumulated in place, so
+    it needs no temporary arrays.
+
+    Parameters
+    ----------
+    source : the local lattice at this step, with up to date ghosts
+    target : the local lattice to write the next step into
+    ghostdefs : the ghost_data of the lattices
+    nu : the diffusion constant times the time step (nonzero)
+    '''
+    sw = ghostdefs.stencil_width
+    ndim = source.ndim
+    inner = (slice(sw,-sw),)*ndim
+    interior = target[inner]
+    numpy.multiply(source[inner], 1/nu-2*ndim, out=interior)
+    for axis in range(ndim):
+        for shift in [-1, 1]:
+            neighbour = list(inner)
+            neighbour[axis] = slice(sw+shift, source.shape[axis]-sw+shift)
+            interior += source[tuple(neighbour)]
+    interior *= nu
+    return
+directview["diffusion_kernel"]=diffusion_kernel
+
+class stepper(object):
+    '''Time-stepping driver.
+
+    Holds two preallocated lattices (with ghost points): on every step
+    the ghosts of the current one are exchanged, the kernel computes the
+    next step from it into the other one and the two are swapped, so
+    nothing is allocated per step. If a statistics_reduction is given,
+    its Iallreduce over the new lattice is started at the end of each
+    step and finished behind the ghost exchange of the next one.
+
+    Callbacks registered with register() are called as callback(self)
+    after every "every" steps, e.g. to write checkpoints or diagnostics:
+
+        driver = stepper(cartesian_topology, ghosts, diffusion_kernel,
+                         reduction=statistics_reduction())
+        driver.register("checkpoint", checkpoint("lattice{step}.dat"), 1000)
+        driver.register("diagnostics", diagnostics(rank_logger(comm)), 10)
+        driver.run(10000)
+
+    The kernel is called as kernel(source, target, ghostdefs) and must
+    write the interior of "target" without touching its ghosts, whose
+    values on non-periodic boundaries stay at zero. With the "shared"
+    ghost exchange neighbours read "source" until the next exchange.
+
+    Parameters
+    ----------
+    topology : an instance of topology
+    ghostdefs : the ghost_data to exchange the ghosts with
+    kernel : the function computing one step, see diffusion_kernel
+    initialiser : the initial values, see initialise_values
+    reduction : an optional statistics_reduction to compute every step
+    timer : an optional phase_timer to record the phases of the steps in
+
+    Attributes
+    ----------
+    step : the number of steps taken
+    arrays : the current and the next lattice
+    callbacks : a dict of (callback, every) keyed by name
+    statistics : the latest statistics finished, if any
+
+    Methods
+    -------
+    current : the lattice at the current step
+    register, unregister : add or remove a callback
+    run : take a number of steps
+    get_statistics : wait for and return the statistics of this step
+    '''
+    def __init__(self, topology, ghostdefs, kernel, initialiser=squared_index,
+                 reduction=None, timer=None):
+        '''See above for details of initialisation.'''
+        self.topology = topology
+        self.ghostdefs = ghostdefs
+        self.kernel = kernel
+        self.reduction = reduction
+        self.timer = timer
+        self.step = 0
+        self.callbacks = {}
+        self.arrays = [initialise_values(topology.me, topology, initialiser,
+                                         ghostdefs=ghostdefs),
+                       ghostdefs.allocate()]
+        self.pending = None
+        self.statistics = None
+    def current(self):
+        return self.arrays[0]
+    def register(self, name, callback, every=1):
+        '''Call callback(self) whenever the step is a multiple of "every".'''
+        self.callbacks[name] = (callback, every)
+    def unregister(self, name):
+        del self.callbacks[name]
+    def get_statistics(self):
+        if (self.pending is not None):
+            self.statistics = self.pending.wait()
+            self.pending = None
+        return self.statistics
+    def run(self, steps):
+        '''Take "steps" steps and return the current lattice.'''
+        timer = self.timer
+        for step in range(steps):
+            source, target = self.arrays
+            if (timer is not None):
+                timer.lap("idle")
+            commslist = ghost_exchange_start(self.topology, source,
+                                             self.ghostdefs)
+            if (timer is not None):
+                timer.lap("post")
+            self.get_statistics()
+            if (timer is not None):
+                timer.lap("reduce")
+            ghost_exchange_finish(commslist)
+            if (timer is not None):
+                timer.lap("wait")
+            self.kernel(source, target, self.ghostdefs)
+            if (timer is not None):
+                timer.lap("compute")
+            self.arrays.reverse()
+            self.step += 1
+            if (self.reduction is not None):
+                self.pending = reduce_statistics(self.topology, target,
+                                                 self.reduction,
+                                                 nonblocking=True)
+                if (timer is not None):
+                    timer.lap("reduce")
+            for callback, every in list(self.callbacks.values()):
+                if (self.step % every == 0):
+                    callback(self)
+        self.get_statistics()
+        return self.current()
+directview["stepper"]=stepper
+
+class checkpoint(object):
+    '''A stepper callback writing the interior of the current lattice into
+    a file of the global lattice in row-major order (raw values of the
+    lattice dtype), with a collective MPI-IO write. As the file does not
+    depend on the decomposition, load() can read it into another one,
+    e.g. after a rebalance.
+
+    Parameters
+    ----------
+    filename : the name of the file; "{step}" is replaced with the step
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+    def open(self, topology, local_array, step, amode):
+        '''Open the file of "step" with a view of the interior of this
+        rank and return it and the datatype of the interior in memory.'''
+        sw = topology.me.stencil_width
+        interior = [n-2*sw for n in local_array.shape]
+        mpitype = dtlib.from_numpy_dtype(local_array.dtype)
+        filetype = mpitype.Create_subarray(topology.globalsizes, interior,
+                                           topology.corner)
+        memtype = mpitype.Create_subarray(list(local_array.shape), interior,
+                                          [sw]*local_array.ndim)
+        filetype.Commit()
+        memtype.Commit()
+        datafile = MPI.File.Open(topology.topology,
+                                 self.filename.format(step=step), amode)
+        datafile.Set_view(0, mpitype, filetype)
+        filetype.Free()
+        return datafile, memtype
+    def __call__(self, stepper):
+        local_array = stepper.current()
+        datafile, memtype = self.open(stepper.topology, local_array,
+                                      stepper.step,
+                                      MPI.MODE_WRONLY | MPI.MODE_CREATE)
+        datafile.Write_all([local_array, 1, memtype])
+        datafile.Close()
+        memtype.Free()
+    def load(self, topology, local_array, step):
+        '''Read the interior of "local_array" from the file of "step".'''
+        datafile, memtype = self.open(topology, local_array, step,
+                                      MPI.MODE_RDONLY)
+        datafile.Read_all([local_array, 1, memtype])
+        datafile.Close()
+        memtype.Free()
+directview["checkpoint"]=checkpoint
+
+class diagnostics(object):
+    '''A stepper callback logging the global statistics of the current
+    lattice from the first rank.
+
+    Parameters
+    ----------
+    logger : a rank_logger
+    reduction : the statistics_reduction to compute; by default the one
+                of the stepper, which is computed anyway
+    '''
+    def __init__(self, logger, reduction=None):
+        self.logger = logger
+        self.reduction = reduction
+    def __call__(self, stepper):
+        if (self.reduction is None):
+            statistics = stepper.get_statistics()
+        else:
+            statistics = reduce_statistics(stepper.topology, stepper.current(),
+                                           self.reduction)
+        msg = None
+        if (stepper.topology.topology.Get_rank() == 0):
+            msg = "step {step}: ".format(step=stepper.step) + ", ".join(
+                "{name}={value}".format(name=name, value=value)
+                for name, value in statistics.items())
+        self.logger.log(msg)
+directview["diagnostics"]=diagnostics
+
+class rebalancer(object):
+    '''Balance the work of the ranks by moving the boundaries between
+    them.
+
+    The compute time of each rank is summed over the slabs of ranks along
+    each axis and spread evenly over the lattice points of the slab. The
+    new boundaries split the total evenly, so the ownership ranges of a
+    lattice which is more expensive in some places than in others follow
+    the cost. Ranges along different axes are balanced independently, as
+    the ranges along each axis are shared by all the ranks of the slab.
+
+    Moving the boundaries means moving the data, so it is done through a
+    checkpoint between runs, see rebalance().
+
+    Parameters
+    ----------
+    tolerance : leave the ranges alone unless the slowest rank takes more
+                than 1+tolerance times the mean compute time
+
+    Methods
+    -------
+    balanced_ranges : the new ownership ranges for given compute times
+    rebalance : move the lattice of a stepper to balanced ranges
+    '''
+    def __init__(self, tolerance=0.05):
+        self.tolerance = tolerance
+    def balanced_ranges(self, topology, elapsed):
+        '''Return the ownership ranges balancing the compute time
+        "elapsed" of each rank, or None if it is balanced well enough.
+        Collective.'''
+        comm = topology.topology
+        records = comm.allgather((comm.Get_coords(comm.Get_rank()),
+                                  float(elapsed)))
+        costs = numpy.array([cost for coords, cost in records])
+        if (costs.max() <= (1+self.tolerance)*costs.mean()):
+            return None
+        minimum = topology.me.stencil_width
+        newranges = []
+        for axis, ranges in enumerate(topology.ownership_ranges):
+            slabcosts = numpy.zeros(len(ranges))
+            for coords, cost in records:
+                slabcosts[coords[axis]] += cost
+            bounds = numpy.concatenate([[0], numpy.cumsum(ranges)])
+            cumulative = numpy.concatenate([[0], numpy.cumsum(slabcosts)])
+            targets = cumulative[-1]*numpy.arange(1, len(ranges))/len(ranges)
+            cuts = numpy.rint(numpy.interp(targets, cumulative,
+                                           bounds)).astype(int)
+            # every rank needs at least a ghost layer worth of points
+            for n in range(len(cuts)):
+                cuts[n] = max(cuts[n], (cuts[n-1] if n > 0 else 0)+minimum)
+            for n in reversed(range(len(cuts))):
+                cuts[n] = min(cuts[n], (cuts[n+1] if n+1 < len(cuts)
+                                        else bounds[-1])-minimum)
+            newranges.append([int(n) for n in numpy.diff(
+                numpy.concatenate([[0], cuts, [bounds[-1]]]))])
+        return newranges
+    def rebalance(self, driver, filename):
+        '''Balance the lattice of the stepper "driver", using the compute
+        time recorded in its phase_timer since the last reset. If the
+        ranks are out of balance, the lattice is written into the
+        checkpoint "filename" and read back into a new stepper with
+        balanced ownership ranges, which continues from the same step with
+        the same kernel, reduction, timer and callbacks. The new topology
+        is built from the old one without reordering, so every rank keeps
+        its place on the rank grid (e.g. the node placement of a
+        decomposition_plan), and the old one is freed.
+
+        Return
+        ------
+        driver : the stepper to continue with, a new one if the lattice
+                 was moved
+        '''
+        timer = driver.timer
+        if (timer is None):
+            raise ValueError("Rebalancing needs a stepper with a phase_timer")
+        ranges = self.balanced_ranges(driver.topology,
+                                      timer.totals[timer.index["compute"]])
+        if (ranges is None):
+            return driver
+        saver = checkpoint(filename)
+        saver(driver)
+        old = driver.topology.me
+        me = rankinfo(stencil_width=old.stencil_width, periods=old.periods,
+                      ownership_ranges=ranges, dtype=old.dtype,
+                      comm=driver.topology.topology)
+        cartesian_topology = topology(me)
+        ghosts = ghost_data(cartesian_topology, me.localsizes,
+                            persistent=driver.ghostdefs.persistent,
+                            stencil=driver.ghostdefs.stencil,
+                            box_exchange=driver.ghostdefs.box_exchange,
+                            method=driver.ghostdefs.method)
+        statistics = driver.get_statistics()
+        moved = stepper(cartesian_topology, ghosts, driver.kernel,
+                        reduction=driver.reduction, timer=timer)
+        saver.load(cartesian_topology, moved.current(), driver.step)
+        moved.step = driver.step
+        moved.statistics = statistics
+        moved.callbacks = dict(driver.callbacks)
+        driver.ghostdefs.free_requests()
+        driver.ghostdefs.free_arrays()
+        driver.topology.topology.Free()
+        timer.reset()
+        return moved
+directview["rebalancer"]=rebalancer
+
 def testme(maxgrad, topology, localsizes):
     '''Test if we get the correct result.
 
+    The data is the square of the global (row-major) index of each
+    point, so the gradient along axis a is 2*index*stride_a. The biggest
+    one is along axis 0, where the stride is largest, at the last point
+    of the last but one plane: the last plane sees the zero boundary of
+    the non-periodic axis 0 above it.
+
     Parameters
     ----------
     maxgrad : the computed result
@@ -390,57 +2012,160 @@ def testme(maxgrad, topology, localsizes):
 
     Return
     ------
-    maxgrad == expected[size-1] : True if the computed "maxgrad" was
-                                  correct, False if not
+    maxgrad == expected : True if the computed "maxgrad" was correct,
+                          False if not
     '''
-    size=topology.topology.Get_size()
-    rank=topology.topology.Get_rank()
-    procsalong, periods, mycoord = topology.topology.Get_topo()
-    nz,ny,nx = procsalong
-    sz,sy,sx = (numpy.array(localsizes)-2)*numpy.array([nz,ny,nx])
-    maximum = 2*sx*sy*(-1+sx*sy*(sz-1))
+    globalsizes = numpy.array(topology.globalsizes)
+    stride = globalsizes[1:].prod()
+    maximum = 2*stride*(-1+stride*(globalsizes[0]-1))
     expected=maximum
     return maxgrad == expected
 directview["testme"]=testme
 
-@directview.remote(block=False)
-def main():
-    '''Main code: run the bits and pieces defined above with the relevant
-    arguments for the demonstration 3x4x5 lattice. This is execured on
-    the remote workers due to the decorator, so return values stay at
-    the workers.
+def simulate(sizes=(3, 4, 5), stencil_width=1, method=None,
+             dtype=numpy.float64):
+    '''Run the bits and pieces defined above with the relevant
+    arguments for one lattice, e.g. the demonstration 3x4x5 one.
+
+    Parameters
+    ----------
+    sizes : the size of the lattice on each rank (without ghost points)
+    stencil_width : the depth of the ghost layer
+    method : the ghost exchange method, see ghost_data
+    dtype : the dtype of the lattice, see rankinfo
 
     Return
     ------
     result_g, local_array : the global maximum of the data, the local
                             portion of the array
     '''
-    me=rankinfo(sizes=[3,4,5])
+    me=rankinfo(sizes=list(sizes), stencil_width=stencil_width, dtype=dtype)
     cartesian_topology=topology(me)
-    ghosts = ghost_data(cartesian_topology, me.localsizes)
+    ghosts = ghost_data(cartesian_topology, me.localsizes, method=method)
     cartesian_topology.print_info()
-    local_array = initialise_values(me, cartesian_topology)
-    gradients = compute_grad(cartesian_topology, local_array, ghosts)
-    result_l, result_g = find_global_max(cartesian_topology, gradients,
-                                         ghosts)
+    local_array = initialise_values(me, cartesian_topology, ghostdefs=ghosts)
+    timer = phase_timer()
+    result_l, result_g = find_global_max_grad(cartesian_topology, local_array,
+                                              ghosts, timer=timer)
+    timings = timer.summary(cartesian_topology.topology)
+    # the rank in the Cartesian communicator, which need not be the one
+    # in COMM_WORLD
+    rank = cartesian_topology.topology.Get_rank()
     serialised_print(
         "Rank {rank} ".format(
-            rank=me.rank)+
+            rank=rank)+
         "had max gradient {maxgrad_l} ".format(
             maxgrad_l=result_l)+
         "while the global was {maxgrad_g}.".format(
             maxgrad_g=result_g),
         cartesian_topology.topology)
-    if (me.rank == 0):
+    if (rank == 0):
         if (testme(result_g, cartesian_topology, me.localsizes)):
             print("Result is correct.")
         else:
             print("Result is incorrect!")
+        for phase, timing in timings["phases"].items():
+            print("{phase:>8}: min {min:.3e} mean {mean:.3e} max {max:.3e} "
+                  "seconds".format(phase=phase, **timing))
+    # the shared memory goes away with the window
+    local_array = local_array.copy()
+    ghosts.free_arrays()
+    cartesian_topology.topology.Free()
     return result_g, local_array
+directview["simulate"]=simulate
 
-results = main()
-try:
-    results.wait()
-    results.display_outputs()
-except:
-    pass
+class task_pipeline(object):
+    '''Queue many runs of a function on the workers and collect the
+    results as they finish.
+
+    A blocking call leaves the workers idle while the front end sends
+    the next task and waits for its result. Instead, we keep "depth"
+    tasks queued on the workers and submit a new one whenever one
+    finishes. Every task runs on all the workers (the MPI ranks), so the
+    workers run the tasks one at a time in submission order and their
+    collectives match. In direct MPI mode every rank is a front end
+    running the tasks in the local pool of directview_class.
+
+    For example, to run the demonstration on several lattices
+
+        pipeline = task_pipeline(simulate)
+        for parameters, result in pipeline.sweep(
+                [{"sizes": [n, n, n]} for n in range(4, 64, 4)]):
+            print(parameters, result)
+
+    Parameters
+    ----------
+    func : the function to run; it must be known to the workers, i.e.
+           registered with directview, and not decorated with
+           directview.remote or directview.parallel
+    view : the view of the workers to run the tasks on; directview by
+           default
+    depth : the number of tasks to keep queued
+
+    Attributes
+    ----------
+    pending : a dict of the arguments of the unfinished tasks, keyed by
+              their AsyncResult (or Future in direct MPI mode)
+
+    Methods
+    -------
+    submit : queue one task
+    completed : return the results of the queued tasks as they finish
+    sweep : run the function for many sets of arguments
+    '''
+    def __init__(self, func, view=None, depth=2):
+        '''See above for details of initialisation.'''
+        self.func = func
+        self.view = directview if view is None else view
+        self.depth = depth
+        self.pending = {}
+    def submit(self, *args, **kwargs):
+        '''Queue func(*args, **kwargs) on the workers and return its
+        AsyncResult.'''
+        task = self.view.apply_async(self.func, *args, **kwargs)
+        self.pending[task] = (args, kwargs)
+        return task
+    def completed(self):
+        '''Yield the args, kwargs and result of each queued task as soon
+        as it finishes. Under ipyparallel the result is a list with the
+        return value of every worker.'''
+        for task in concurrent.futures.as_completed(list(self.pending)):
+            args, kwargs = self.pending.pop(task)
+            yield args, kwargs, task.result()
+    def sweep(self, parametersets):
+        '''Run func once for each dict of keyword arguments in
+        "parametersets", keeping "depth" tasks queued, and yield the
+        keyword arguments and result of each run as soon as it finishes.'''
+        parametersets = iter(parametersets)
+        for parameters in itertools.islice(parametersets, self.depth):
+            self.submit(**parameters)
+        while (self.pending):
+            task = next(concurrent.futures.as_completed(list(self.pending)))
+            args, kwargs = self.pending.pop(task)
+            # top up the queue before handing back the result
+            for parameters in itertools.islice(parametersets, 1):
+                self.submit(**parameters)
+            yield kwargs, task.result()
+directview["task_pipeline"]=task_pipeline
+
+@directview.remote(block=False)
+def main(sizes=(3, 4, 5), stencil_width=1, method=None, dtype=numpy.float64):
+    '''Main code: run the demonstration 3x4x5 lattice (or the one given).
+    This is execured on the remote workers due to the decorator, so
+    return values stay at the workers.
+
+    Return
+    ------
+    result_g, local_array : the global maximum of the data, the local
+                            portion of the array
+    '''
+    return simulate(sizes, stencil_width, method, dtype)
+
+if (__name__ == "__main__"):
+    results = main()
+    try:
+        results.wait()
+        results.display_outputs()
+    except AttributeError:
+        # a concurrent.futures.Future in direct MPI mode
+        results.result()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''Find the best ghost layer depth for the diffusion stepper in
+distributed_computing_universal.py for a given lattice and rank count.
+
+A ghost layer "depth" points deep allows "depth" time steps between
+ghost exchanges: we send fewer, larger messages but recompute a growing
+part of the ghost layer on every step. Which one wins depends on the
+lattice size, the number of ranks and the network, so we just measure.
+
+Usage: mpirun -n P python3 halo_depth_benchmark.py [nz ny nx [maxdepth [steps]]]
+
+where nz, ny, nx is the size of the lattice on each rank (without the
+ghost points), maxdepth the deepest ghost layer to try and steps the
+number of time steps to take with each depth.
+'''
+import sys
+import numpy
+import mpi4py
+from mpi4py import MPI
+from distributed_computing_universal import (rankinfo, topology, ghost_data,
+                                             initialise_values,
+                                             ghost_exchange_start,
+                                             ghost_exchange_finish,
+                                             diffusion_steps)
+
+def run_depth(sizes, depth, steps):
+    '''Take "steps" diffusion steps with a ghost layer "depth" points
+    deep, exchanging ghosts every "depth" steps.
+
+    Parameters
+    ----------
+    sizes : the lattice size on each rank without ghost points
+    depth : the depth of the ghost layer
+    steps : the number of time steps
+
+    Returns
+    -------
+    elapsed, checksum : the wall clock time of the slowest rank and the
+                        global sum of the lattice at the end
+    '''
+    me = rankinfo(sizes=sizes, stencil_width=depth)
+    cartesian_topology = topology(me)
+    # several steps between exchanges need the edges and corners, too
+    ghosts = ghost_data(cartesian_topology, me.localsizes, stencil="box")
+    local_array = initialise_values(me, cartesian_topology, ghostdefs=ghosts)
+    # keep the values in a sane range: the initial data grows like N**2;
+    # scale by the global maximum so the field is the same on any rank count
+    local_max = numpy.array(local_array.max())
+    global_max = numpy.zeros_like(local_max)
+    cartesian_topology.topology.Allreduce([local_max, MPI.DOUBLE],
+                                          [global_max, MPI.DOUBLE],
+                                          op=MPI.MAX)
+    local_array /= global_max if global_max > 0 else 1
+    cartesian_topology.topology.Barrier()
+    start = MPI.Wtime()
+    for step in range(0, steps, depth):
+        ghost_exchange_finish(ghost_exchange_start(cartesian_topology,
+                                                   local_array, ghosts))
+        diffusion_steps(local_array, ghosts, min(depth, steps-step))
+    elapsed = numpy.array(MPI.Wtime()-start)
+    elapsed_max = numpy.zeros_like(elapsed)
+    cartesian_topology.topology.Allreduce([elapsed, MPI.DOUBLE],
+                                          [elapsed_max, MPI.DOUBLE],
+                                          op=MPI.MAX)
+    checksum = numpy.array(local_array[(slice(depth,-depth),)*local_array.ndim].sum())
+    checksum_global = numpy.zeros_like(checksum)
+    cartesian_topology.topology.Allreduce([checksum, MPI.DOUBLE],
+                                          [checksum_global, MPI.DOUBLE],
+                                          op=MPI.SUM)
+    ghosts.free_arrays()
+    cartesian_topology.topology.Free()
+    return float(elapsed_max), float(checksum_global)
+
+def main(sizes, maxdepth, steps):
+    '''Time every depth from 1 to "maxdepth" and report the fastest.'''
+    timings = {}
+    for depth in range(1, maxdepth+1):
+        timings[depth] = run_depth(sizes, depth, steps)
+    if (MPI.COMM_WORLD.Get_rank() == 0):
+        print("lattice {sizes} per rank on {size} ranks, {steps} steps".format(
+            sizes=sizes, size=MPI.COMM_WORLD.Get_size(), steps=steps))
+        print("{:>6} {:>12} {:>12} {:>22}".format("depth", "time/s",
+                                                  "time/step", "checksum"))
+        for depth, (elapsed, checksum) in sorted(timings.items()):
+            print("{:>6} {:>12.6f} {:>12.3e} {:>22.15e}".format(
+                depth, elapsed, elapsed/steps, checksum))
+        best = min(timings, key=lambda depth: timings[depth][0])
+        print("Best ghost layer depth: {best}".format(best=best))
+    return timings
+
+if (__name__ == "__main__"):
+    sizes = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else [32, 32, 32]
+    maxdepth = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    steps = int(sys.argv[5]) if len(sys.argv) > 5 else 24
+    main(sizes, maxdepth, steps)
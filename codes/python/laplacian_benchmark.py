@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+'''Benchmark harness for the Laplacian kernels of optimising_laplacian.py.
+
+Every kernel has the signature kernel(data, lapl, d, N) of Laplacian0 and
+friends: "data" is the input lattice, "lapl" the output, "d" the lattice
+spacings and N the number of threads to use. Each kernel is run a few
+times untimed to warm up (caches, page faults of the output, OpenMP
+thread pools) and then timed "repeats" times with time.perf_counter; we
+report the median and the spread, which are far less noisy than a single
+run. Timing the calls directly avoids the overhead cProfile adds to every
+Python function call, which penalised the pure Python kernels.
+
+The rates are roofline style: GFLOP/s counts "flops_per_point" floating
+point operations per interior point, and GB/s the compulsory memory
+traffic of reading "data" and writing "lapl" once each. Their ratio is
+the arithmetic intensity, so comparing GB/s with the STREAM bandwidth of
+the machine shows how close to the memory bound a kernel is.
+
+Kernels are named like "Laplacian2" (looked up in a namespace, e.g. the
+globals of optimising_laplacian.py) or "cyLaplacian6.cyLaplacian6" (the
+module is imported with importlib), so nothing is eval()ed. Kernels which
+cannot be found are reported and skipped. Compiled kernels are imported
+as built by setup_kernels.py, and only those which have not been built
+are compiled with pyximport on first use.
+
+Usage: python3 laplacian_benchmark.py [--sizes N [N ...]]
+           [--threads T [T ...]] [--warmup W] [--repeats R]
+           [--first-touch] [--output FILE] [kernel [kernel ...]]
+
+With --first-touch the lattices are placed on the NUMA nodes of the
+threads with cyFirstTouch, matching the runs with the largest thread
+count. That only helps if cyLaplacian6 shares its planes out statically,
+so OMP_SCHEDULE defaults to static then (see static_schedule).
+
+The results of every run are appended to the JSON file, together with the
+host and library versions, so that regressions can be tracked over time.
+'''
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import sys
+import time
+import numpy
+
+# the compiled and cache-blocked kernels; only the threaded ones use N
+KERNELS = [{"func": "cyLaplacian1.cyLaplacian1", "flops_per_point": 14},
+           {"func": "cyLaplacian2.cyLaplacian2", "flops_per_point": 14},
+           {"func": "cyLaplacian3.cyLaplacian3", "flops_per_point": 14},
+           {"func": "cyLaplacian4.cyLaplacian3", "flops_per_point": 14},
+           {"func": "cyLaplacian5.cyLaplacian5", "flops_per_point": 14},
+           {"func": "cyLaplacian6.cyLaplacian6", "flops_per_point": 14,
+            "threaded": True},
+           {"func": "cyLaplacian_tiled.cyLaplacian_tiled", "flops_per_point": 14,
+            "threaded": True},
+           {"func": "laplacian_kernels.tiled_laplacian", "flops_per_point": 14,
+            "threaded": True},
+           # 8 Jacobi steps of 16 flops per call on "data" in place; GB/s
+           # counts one pass over the lattice like for the other kernels,
+           # an unblocked kernel would need 8 times that for the same rate
+           {"func": "cyJacobi_tiled.cyJacobi_tiled", "flops_per_point": 128,
+            "threaded": True, "inplace": True},
+           {"func": "laplacian_kernels.jacobi_steps", "flops_per_point": 128,
+            "threaded": True, "inplace": True}]
+
+def init_lattice(size):
+    '''Return the arguments of the kernels for a size**3 lattice, like
+    Init in optimising_laplacian.py.'''
+    d=numpy.array([0.1,0.1,0.1])
+    data=numpy.random.random([size]*3)
+    lapl=numpy.zeros_like(data)
+    return {"data": data, "laplacian": lapl, "lattice_spacing": d}
+
+def install_pyximport():
+    '''Let .pyx modules be compiled on import, if pyximport is there, and
+    return whether it is. It is appended to the import machinery, so
+    modules built ahead of time are still found first.'''
+    try:
+        import pyximport
+    except ImportError:
+        return False
+    pyximport.install(setup_args={'include_dirs': numpy.get_include()})
+    return True
+
+def import_kernel_module(module):
+    '''Import "module", compiling it with pyximport only if it has not
+    been built ahead of time with setup_kernels.py.'''
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        if (not install_pyximport()):
+            raise
+        return importlib.import_module(module)
+
+# the modules which load the OpenMP runtime
+OPENMP_MODULES = ["cyLaplacian6", "cyLaplacian_tiled", "cyJacobi_tiled",
+                  "cyFirstTouch", "cyVectorLaplacian"]
+
+def static_schedule():
+    '''Make the schedule="runtime" loop of cyLaplacian6 static, as
+    cyFirstTouch assumes, unless OMP_SCHEDULE says otherwise, and warn if
+    the placement will not match. The OpenMP runtime reads OMP_SCHEDULE
+    when it is loaded, so this must come before the first OpenMP module
+    is imported.'''
+    if ("OMP_SCHEDULE" not in os.environ):
+        loaded = [name for name in OPENMP_MODULES if name in sys.modules]
+        if (loaded):
+            print("Warning: OpenMP already loaded by {loaded}, too late to "
+                  "make the schedule static; first touch placement will not "
+                  "match cyLaplacian6".format(loaded=", ".join(loaded)))
+        os.environ["OMP_SCHEDULE"] = "static"
+    elif (not os.environ["OMP_SCHEDULE"].strip().lower().startswith("static")):
+        print("Warning: OMP_SCHEDULE={schedule} is not static, so first touch "
+              "placement will not match cyLaplacian6".format(
+                  schedule=os.environ["OMP_SCHEDULE"]))
+
+def first_touch_lattice(size, threads):
+    '''Return the arguments of the kernels for a size**3 lattice like
+    init_lattice, but with the pages of both lattices placed on the NUMA
+    nodes of the "threads" threads of cyLaplacian6 (see cyFirstTouch), or
+    like init_lattice if cyFirstTouch cannot be imported. OMP_SCHEDULE is
+    made static first, see static_schedule.'''
+    static_schedule()
+    try:
+        cyFirstTouch = import_kernel_module("cyFirstTouch")
+    except ImportError as error:
+        print("Not placing the lattices: {error}".format(error=error))
+        return init_lattice(size)
+    return cyFirstTouch.first_touch_init(size, threads)
+
+def resolve(name, namespace=None):
+    '''Return the kernel called "name": "module.function" is imported from
+    "module", a plain name is looked up in the dict "namespace".'''
+    if ("." in name):
+        module, function = name.rsplit(".", 1)
+        return getattr(import_kernel_module(module), function)
+    if (namespace is None or name not in namespace):
+        raise KeyError("No kernel called {name}".format(name=name))
+    return namespace[name]
+
+def time_kernel(func, variables, threads, warmup=1, repeats=5, inplace=False):
+    '''Return an array of the wall clock times of "repeats" calls of
+    "func" after "warmup" untimed ones. An "inplace" kernel, which changes
+    its input, is given a copy of it, reset before every call outside
+    the timing, so every call sees the same input and "variables" is left
+    alone.'''
+    data = variables["data"].copy() if inplace else variables["data"]
+    args = (data, variables["laplacian"], variables["lattice_spacing"],
+            threads)
+    for n in range(warmup):
+        if (inplace):
+            data[...] = variables["data"]
+        func(*args)
+    times = numpy.empty(repeats)
+    for n in range(repeats):
+        if (inplace):
+            data[...] = variables["data"]
+        start = time.perf_counter()
+        func(*args)
+        times[n] = time.perf_counter()-start
+    return times
+
+def summarise(times, flop, nbytes):
+    '''Return a dict of the statistics of "times" and the rates they
+    give for "flop" floating point operations and "nbytes" bytes.'''
+    quartiles = numpy.percentile(times, [25, 50, 75])
+    median = float(quartiles[1])
+    return {"median": median,
+            "min": float(times.min()),
+            "max": float(times.max()),
+            "iqr": float(quartiles[2]-quartiles[0]),
+            "relative_spread": float((quartiles[2]-quartiles[0])/median),
+            "times": [float(t) for t in times],
+            "flop": int(flop),
+            "bytes": int(nbytes),
+            "intensity": flop/nbytes,
+            "gflops": flop/median/1e9,
+            "gbytes": nbytes/median/1e9}
+
+def run_benchmarks(kernels, sizes, threads=(1,), warmup=1, repeats=5,
+                   namespace=None, init=init_lattice, verbose=True):
+    '''Benchmark each kernel on each lattice size and thread count.
+
+    Parameters
+    ----------
+    kernels : a list of dicts of the kernel name "func", its
+              "flops_per_point" (14 if not given), whether it is
+              "threaded" (kernels which are not are only run with the
+              first thread count) and whether it changes its input
+              "inplace"
+    sizes : the lattice sizes (along each axis, with the boundary)
+    threads : the thread counts to pass to the threaded kernels
+    warmup, repeats : the number of untimed and timed calls
+    namespace : a dict to look up kernel names without a module in
+    init : a function returning the kernel arguments for a size
+    verbose : print each result as it comes
+
+    Returns
+    -------
+    results : a list of dicts of the "func", "size", "threads" and the
+              statistics of summarise
+    '''
+    results = []
+    for size in sizes:
+        variables = init(size)
+        data = variables["data"]
+        for kernel in kernels:
+            try:
+                func = resolve(kernel["func"], namespace)
+            except (ImportError, AttributeError, KeyError) as error:
+                print("Skipping {func}: {error}".format(func=kernel["func"],
+                                                        error=error))
+                continue
+            flop = kernel.get("flops_per_point", 14)*(size-2)**3
+            nbytes = 2*data.itemsize*data.size
+            for nthreads in (threads if kernel.get("threaded") else threads[:1]):
+                times = time_kernel(func, variables, nthreads, warmup, repeats,
+                                    kernel.get("inplace", False))
+                result = {"func": kernel["func"], "size": size,
+                          "threads": nthreads}
+                result.update(summarise(times, flop, nbytes))
+                results.append(result)
+                if (verbose):
+                    print("{func} size {size} threads {threads}: median "
+                          "{median:.4e} s (spread {relative_spread:.1%}) at "
+                          "{gflops:.3f} GF/s, {gbytes:.3f} GB/s".format(
+                              **result))
+    return results
+
+def save_results(filename, results, **metadata):
+    '''Append a run of "results" to the JSON file "filename", with the
+    date, host and versions and any other "metadata".'''
+    runs = []
+    if (os.path.exists(filename)):
+        with open(filename) as datafile:
+            runs = json.load(datafile)
+    metadata.update({"date": datetime.datetime.now().isoformat(),
+                     "host": platform.node(),
+                     "machine": platform.machine(),
+                     "cpus": os.cpu_count(),
+                     "python": platform.python_version(),
+                     "numpy": numpy.__version__,
+                     "omp_schedule": os.environ.get("OMP_SCHEDULE"),
+                     "omp_proc_bind": os.environ.get("OMP_PROC_BIND")})
+    runs.append({"metadata": metadata, "results": results})
+    with open(filename, "w") as datafile:
+        json.dump(runs, datafile, indent=1)
+    return runs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Laplacian kernels.")
+    parser.add_argument("kernels", type=str, nargs="*",
+                        default=[kernel["func"] for kernel in KERNELS],
+                        help="module.function names of the kernels")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 200],
+                        help="lattice sizes to sweep")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1],
+                        help="thread counts to sweep")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="untimed runs before timing")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="timed runs")
+    parser.add_argument("--first-touch", action="store_true",
+                        help="place the lattices on the NUMA nodes of the "
+                        "threads of the largest thread count")
+    parser.add_argument("--output", type=str,
+                        default="laplacian_benchmark.json",
+                        help="JSON file to append the results to")
+    args = parser.parse_args(argv)
+    known = dict((kernel["func"], kernel) for kernel in KERNELS)
+    # sweep the threads of kernels we know nothing about, just in case
+    kernels = [known.get(name, {"func": name, "threaded": True})
+               for name in args.kernels]
+    init = init_lattice
+    if (args.first_touch):
+        static_schedule()
+        init = lambda size: first_touch_lattice(size, max(args.threads))
+    results = run_benchmarks(kernels, args.sizes, args.threads, args.warmup,
+                             args.repeats, init=init)
+    save_results(args.output, results, argv=sys.argv)
+    return results
+
+if (__name__ == "__main__"):
+    main()
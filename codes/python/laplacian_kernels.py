@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+'''Cache-blocked NumPy Laplacian kernels, with the signature
+kernel(data, lapl, d, N) of the kernels in optimising_laplacian.py.
+
+Laplacian3 and friends evaluate each term of the stencil over the whole
+lattice, so every temporary is as large as the lattice and makes another
+round trip to memory. On large lattices (500**3 and up) that makes them
+memory bound long before they run out of floating point operations.
+Here the j/k plane is cut into tiles small enough that a few planes of a
+tile fit into the cache, and each tile is streamed through along i in
+chunks, accumulating into "lapl" through small preallocated buffers with
+the out= arguments of the ufuncs. Each point of "data" is then read from
+memory close to once, and no lattice-sized temporary is ever allocated.
+
+The lattices may have trailing axes after the three spatial ones, e.g.
+the interleaved (nx, ny, nz, ncomp) layout of a DMDA with dof=ncomp: all
+components are then computed in the same pass over a tile, so each
+neighbour is loaded once for all of them instead of once per component.
+stacked_laplacian takes (ncomp, nx, ny, nz) stacks of fields too, but
+only for convenience: see its docstring.
+'''
+import concurrent.futures
+import numpy
+
+# the size of the cache a tile (and its neighbouring planes) should fit
+# in; larger than the L2 of most cores, as every ufunc call has an
+# overhead of a few microseconds which small tiles cannot amortise
+CACHE_BYTES = 1048576
+
+def laplacian_tile(shape, itemsize, cache_bytes=CACHE_BYTES):
+    '''Return the (ti, tj, tk) tile of the interior of a lattice "shape"
+    with "itemsize" bytes per point whose working set fits in half of
+    "cache_bytes". The last axis is kept whole if at all possible, so the
+    inner loops stay long and contiguous. Axes after the first three are
+    components of each point.'''
+    itemsize = itemsize*int(numpy.prod(shape[3:]))
+    interior = [max(1, n-2) for n in shape[:3]]
+    # the working set of a chunk of ti tj x tk planes is 3 ti+2 planes:
+    # ti+2 of data (with the neighbours along i), ti of lapl and ti of
+    # the buffer; "points" of them fit in half of the cache
+    points = max(1, cache_bytes//(2*itemsize))
+    tk = min(interior[2], max(1, points//5))
+    tj = max(1, min(interior[1], points//(5*tk)))
+    ti = max(1, min(interior[0], (points//(tj*tk)-2)//3))
+    return ti, tj, tk
+
+def _tiles(shape, tile):
+    '''Return the list of (j, k) slices tiling the interior of "shape".'''
+    return [(slice(j, min(j+tile[1], shape[1]-1)),
+             slice(k, min(k+tile[2], shape[2]-1)))
+            for j in range(1, shape[1]-1, tile[1])
+            for k in range(1, shape[2]-1, tile[2])]
+
+def _laplacian_tiles(data, lapl, weights, tiles, ti):
+    '''Compute "lapl" on the (j, k) "tiles" of "data" in chunks of "ti"
+    planes along i.'''
+    wx, wy, wz, wc = weights
+    tj = max(jk[0].stop-jk[0].start for jk in tiles)
+    tk = max(jk[1].stop-jk[1].start for jk in tiles)
+    buffer = numpy.empty(ti*tj*tk*int(numpy.prod(lapl.shape[3:])),
+                         dtype=lapl.dtype)
+    for js, ks in tiles:
+        jl = slice(js.start-1, js.stop-1)
+        jh = slice(js.start+1, js.stop+1)
+        kl = slice(ks.start-1, ks.stop-1)
+        kh = slice(ks.start+1, ks.stop+1)
+        for i in range(1, data.shape[0]-1, ti):
+            ii = slice(i, min(i+ti, data.shape[0]-1))
+            il = slice(ii.start-1, ii.stop-1)
+            ih = slice(ii.start+1, ii.stop+1)
+            out = lapl[ii, js, ks]
+            tmp = buffer[:out.size].reshape(out.shape)
+            numpy.multiply(data[ii, js, ks], wc, out=out)
+            for lo, hi, w in ((data[il, js, ks], data[ih, js, ks], wx),
+                              (data[ii, jl, ks], data[ii, jh, ks], wy),
+                              (data[ii, js, kl], data[ii, js, kh], wz)):
+                numpy.add(lo, hi, out=tmp)
+                tmp *= w
+                out += tmp
+
+def tiled_laplacian(data, lapl, d, N, tile=None):
+    '''Compute the Laplacian of the 3D array "data" into the interior of
+    "lapl" tile by tile.
+
+    Parameters
+    ----------
+    data : the input lattice; any axes after the first three are
+           components, each of which gets its own Laplacian
+    lapl : the output lattice, of the shape of "data"; its boundary is
+           left alone
+    d : the lattice spacings along the three axes
+    N : the number of threads; the tiles are shared out between them
+        (NumPy releases the GIL in the ufuncs)
+    tile : the (ti, tj, tk) size of the tiles, laplacian_tile by default
+
+    Returns
+    -------
+    None
+    '''
+    if (min(data.shape[:3]) < 3):
+        return
+    if (tile is None):
+        tile = laplacian_tile(data.shape, data.itemsize)
+    dx2, dy2, dz2 = [1./(h*h) for h in d]
+    weights = (dx2, dy2, dz2, -2*(dx2+dy2+dz2))
+    tiles = _tiles(data.shape, tile)
+    if (N <= 1 or len(tiles) == 1):
+        _laplacian_tiles(data, lapl, weights, tiles, tile[0])
+        return
+    # contiguous runs of tiles for each thread, like a static schedule
+    nthreads = min(N, len(tiles))
+    bounds = numpy.linspace(0, len(tiles), nthreads+1).astype(int)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = [pool.submit(_laplacian_tiles, data, lapl, weights,
+                               tiles[bounds[n]:bounds[n+1]], tile[0])
+                   for n in range(nthreads)]
+        for future in futures:
+            future.result()
+
+def stacked_laplacian(data, lapl, d, N, tile=None):
+    '''Compute the Laplacians of a (ncomp, nx, ny, nz) stack of fields
+    "data" into the interior of the stack "lapl" with tiled_laplacian.
+
+    This is only a convenience wrapper: the components are far apart in
+    memory, so the strided view tiled_laplacian works on still loads the
+    neighbours of each component separately and saves no memory traffic
+    over one call per component. Use cyVectorLaplacian.cyStackedLaplacian
+    for stacks, or better keep the components interleaved as
+    (nx, ny, nz, ncomp) for tiled_laplacian or
+    cyVectorLaplacian.cyVectorLaplacian.'''
+    tiled_laplacian(numpy.moveaxis(data, 0, -1), numpy.moveaxis(lapl, 0, -1),
+                    d, N, tile)
+
+def jacobi_steps(data, work, d, N, steps=8, omega=1.):
+    '''Take "steps" weighted Jacobi steps
+    u += omega/(2*(dx2+dy2+dz2))*Laplacian(u) on "data" in place with
+    tiled_laplacian, keeping its boundary fixed; "work" is a scratch
+    lattice of the shape of "data". Every step streams the lattice through
+    memory again, so this is the reference for the temporally blocked
+    cyJacobi_tiled, which takes the same arguments.'''
+    if (min(data.shape) < 3):
+        return
+    scale = omega/(2*sum(1./(h*h) for h in d))
+    interior = (slice(1, -1),)*3
+    for step in range(steps):
+        tiled_laplacian(data, work, d, N)
+        work[interior] *= scale
+        data[interior] += work[interior]
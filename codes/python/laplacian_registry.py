@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+'''One entry point for all the Laplacian kernels.
+
+    from laplacian_registry import laplacian
+    laplacian(data, out, d)
+
+computes the Laplacian of the 3D lattice "data" into the interior of
+"out" with whichever kernel is fastest on this host for lattices of that
+shape and dtype. The first call for a shape checks which of BACKENDS can
+be imported here (the compiled ones need building with setup_kernels.py
+or Cython and a compiler for pyximport), checks
+each against the NumPy reference on a small lattice, times the ones which
+agree with laplacian_benchmark and caches the winner, both in memory and
+in a JSON file (LAPLACIAN_REGISTRY_CACHE, ~/.cache/laplacian_registry.json
+by default) keyed by the host, so later runs dispatch straight away.
+Delete the file (or call registry.forget()) after changing the kernels.
+
+The number of threads given to the threaded kernels is OMP_NUM_THREADS
+if it is set and the number of CPUs otherwise.
+'''
+import json
+import os
+import platform
+import warnings
+import numpy
+import laplacian_benchmark
+import laplacian_kernels
+
+# in order of preference when the timings are a tie
+BACKENDS = [{"func": "cyLaplacian6.cyLaplacian6", "threaded": True},
+            {"func": "cyLaplacian_tiled.cyLaplacian_tiled", "threaded": True},
+            {"func": "cyLaplacian5.cyLaplacian5"},
+            {"func": "cyLaplacian3.cyLaplacian3"},
+            {"func": "laplacian_kernels.tiled_laplacian", "threaded": True}]
+# always there, so every lattice has a kernel
+FALLBACK = "laplacian_kernels.tiled_laplacian"
+# the filename of a registry which was not given one, see default_cache
+DEFAULT_CACHE = object()
+
+def default_cache():
+    '''Return the name of the file to cache the selections in.'''
+    return os.environ.get("LAPLACIAN_REGISTRY_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache",
+                                       "laplacian_registry.json"))
+
+def default_threads():
+    '''Return the number of threads to give the threaded kernels.'''
+    if ("OMP_NUM_THREADS" in os.environ):
+        return int(os.environ["OMP_NUM_THREADS"])
+    return os.cpu_count() or 1
+
+class kernel_registry(object):
+    '''Selects, caches and dispatches to the fastest Laplacian kernel.
+
+    Parameters
+    ----------
+    backends : a list of dicts of the "func" names of the candidate
+               kernels (as for laplacian_benchmark.resolve) and whether
+               they are "threaded"
+    filename : the JSON file to cache the selections in, default_cache()
+               if not given, or None to only keep them in memory
+    warmup, repeats : the number of untimed and timed calls of each
+                      candidate
+    '''
+    def __init__(self, backends=BACKENDS, filename=DEFAULT_CACHE, warmup=1,
+                 repeats=3):
+        self.backends = backends
+        self.filename = default_cache() if filename is DEFAULT_CACHE else filename
+        self.warmup = warmup
+        self.repeats = repeats
+        self.selected = {}
+        self.kernels = {}
+
+    def resolve(self, name):
+        '''Return the kernel called "name", or None if it cannot be
+        imported here. Only this module is imported, so dispatching to a
+        cached selection does not build or load the other backends.'''
+        if (name not in self.kernels):
+            try:
+                self.kernels[name] = laplacian_benchmark.resolve(name)
+            except Exception:
+                # not built here, or cannot be built at all
+                self.kernels[name] = None
+        return self.kernels[name]
+
+    def available(self):
+        '''Return a dict of the kernels of the backends which can be
+        imported, by name.'''
+        kernels = dict((backend["func"], self.resolve(backend["func"]))
+                       for backend in self.backends)
+        return dict((name, func) for name, func in kernels.items()
+                    if func is not None)
+
+    def key(self, shape, dtype, threads):
+        '''Return the cache key of a lattice on this host.'''
+        return "{host}:{shape}:{dtype}:{threads}".format(
+            host=platform.node(), shape="x".join(str(n) for n in shape),
+            dtype=numpy.dtype(dtype).name, threads=threads)
+
+    def load(self):
+        '''Return the selections cached on disk.'''
+        if (self.filename and os.path.exists(self.filename)):
+            try:
+                with open(self.filename) as cachefile:
+                    return json.load(cachefile)
+            except (ValueError, OSError):
+                # a half written file from a job killed at the wrong moment,
+                # or one we may not read
+                return {}
+        return {}
+
+    def save(self, key, name):
+        '''Add the selection "name" for "key" to the file on disk, if it
+        can be written: otherwise the selection is only kept in memory.'''
+        if (not self.filename):
+            return
+        cache = self.load()
+        cache[key] = name
+        directory = os.path.dirname(self.filename)
+        temporary = "{filename}.{pid}".format(filename=self.filename,
+                                              pid=os.getpid())
+        try:
+            if (directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(temporary, "w") as cachefile:
+                json.dump(cache, cachefile, indent=1)
+            os.replace(temporary, self.filename)
+        except OSError as error:
+            # e.g. a read only or full home directory on a compute node
+            warnings.warn("Not caching the Laplacian kernel selection: "
+                          "{error}".format(error=error), RuntimeWarning)
+
+    def forget(self):
+        '''Drop all selections, in memory and on disk.'''
+        self.selected = {}
+        if (self.filename and os.path.exists(self.filename)):
+            os.remove(self.filename)
+
+    def candidates(self, dtype, d):
+        '''Return the names of the available kernels which agree with the
+        reference on a small lattice of "dtype".'''
+        data = numpy.random.random([12, 9, 7]).astype(dtype)
+        reference = numpy.zeros_like(data)
+        laplacian_kernels.tiled_laplacian(data, reference, d, 1)
+        names = []
+        for name, func in self.available().items():
+            out = numpy.zeros_like(data)
+            try:
+                func(data, out, d, 1)
+            except (ValueError, TypeError):
+                # e.g. a compiled kernel for another dtype
+                continue
+            if (numpy.allclose(out, reference, rtol=1e-4)):
+                names.append(name)
+        return names
+
+    def benchmark(self, shape, dtype, d, threads):
+        '''Time the candidates on a lattice "shape" and return the name
+        of the fastest.'''
+        names = self.candidates(dtype, d)
+        if (len(names) < 2):
+            return names[0] if names else FALLBACK
+        threaded = dict((backend["func"], backend.get("threaded", False))
+                        for backend in self.backends)
+        variables = {"data": numpy.random.random(shape).astype(dtype),
+                     "laplacian": numpy.zeros(shape, dtype=dtype),
+                     "lattice_spacing": d}
+        medians = {}
+        for name in names:
+            times = laplacian_benchmark.time_kernel(
+                self.available()[name], variables,
+                threads if threaded[name] else 1, self.warmup, self.repeats)
+            medians[name] = numpy.median(times)
+        return min(names, key=lambda name: medians[name])
+
+    def select(self, shape, dtype, d, threads):
+        '''Return the name of the kernel for a lattice "shape" of "dtype",
+        benchmarking the candidates if no selection is cached.'''
+        key = self.key(shape, dtype, threads)
+        if (key not in self.selected):
+            name = self.load().get(key)
+            if (name is None or self.resolve(name) is None):
+                name = self.benchmark(shape, dtype, d, threads)
+                self.save(key, name)
+            self.selected[key] = name
+        return self.selected[key]
+
+    def __call__(self, data, out, d, threads=None):
+        '''Compute the Laplacian of "data" into the interior of "out" with
+        the selected kernel.'''
+        if (threads is None):
+            threads = default_threads()
+        d = numpy.asarray(d, dtype=numpy.float64)
+        name = self.select(data.shape, data.dtype, d, threads)
+        threaded = [backend.get("threaded", False)
+                    for backend in self.backends if backend["func"] == name]
+        self.resolve(name)(data, out, d, threads if any(threaded) else 1)
+        return out
+
+registry = kernel_registry()
+
+def laplacian(data, out, d, threads=None):
+    '''Compute the Laplacian of the 3D array "data" into the interior of
+    "out" with the fastest kernel on this host, see kernel_registry.
+
+    Parameters
+    ----------
+    data : the input lattice
+    out : the output lattice, of the shape of "data"
+    d : the lattice spacings along the three axes
+    threads : the number of threads, default_threads() by default
+
+    Returns
+    -------
+    out : the output lattice
+    '''
+    return registry(data, out, d, threads)
+
+if (__name__ == "__main__"):
+    import sys
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    variables = laplacian_benchmark.init_lattice(size)
+    laplacian(variables["data"], variables["laplacian"],
+              variables["lattice_spacing"])
+    print("Selected {name} for {size}**3 lattices on {host}".format(
+        name=registry.selected[registry.key(variables["data"].shape,
+                                            variables["data"].dtype,
+                                            default_threads())],
+        size=size, host=platform.node()))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''Find the best OpenMP schedule and thread affinity for cyLaplacian6.
+
+cyLaplacian6 shares its outermost loop out with schedule="runtime", so
+the schedule comes from OMP_SCHEDULE (and the placement of the threads
+from OMP_PROC_BIND and OMP_PLACES), which the OpenMP runtime reads only
+once, when the process starts. Every combination of schedule, chunk size
+and binding is therefore timed in a fresh process running
+laplacian_benchmark.py, which sweeps the lattice sizes and thread counts
+itself. The fastest combination for each lattice size is printed as the
+lines to put into a job script and saved, with all the timings, to the
+output file.
+
+Usage: python3 omp_sweep.py [--sizes N [N ...]] [--threads T [T ...]]
+           [--schedules S [S ...]] [--chunks C [C ...]]
+           [--binds B [B ...]] [--places P] [--repeats R]
+           [--kernel module.function] [--output FILE]
+
+A chunk of 0 means the default chunk of the schedule. Run it on a compute
+node of the kind the jobs will run on, with the node to yourself.
+'''
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def omp_environment(schedule, chunk, bind, places):
+    '''Return the OpenMP environment variables of a configuration.'''
+    environment = {"OMP_SCHEDULE": schedule if chunk <= 0
+                   else "{schedule},{chunk}".format(schedule=schedule,
+                                                    chunk=chunk),
+                   "OMP_PROC_BIND": bind}
+    if (bind != "false" and places):
+        environment["OMP_PLACES"] = places
+    return environment
+
+def run_configuration(kernel, sizes, threads, environment, repeats=5):
+    '''Benchmark "kernel" in a new process with the OpenMP "environment"
+    and return the results of laplacian_benchmark.run_benchmarks.'''
+    env = dict(os.environ)
+    env.update(environment)
+    env.pop("OMP_NUM_THREADS", None)
+    with tempfile.TemporaryDirectory() as scratch:
+        output = os.path.join(scratch, "results.json")
+        command = ([sys.executable, os.path.join(HERE, "laplacian_benchmark.py"),
+                    "--sizes"]+[str(size) for size in sizes]+
+                   ["--threads"]+[str(nthreads) for nthreads in threads]+
+                   ["--repeats", str(repeats), "--output", output, kernel])
+        subprocess.run(command, env=env, cwd=HERE, check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(output) as datafile:
+            return json.load(datafile)[-1]["results"]
+
+def sweep(kernel, sizes, threads, schedules, chunks, binds, places,
+          repeats=5, verbose=True):
+    '''Time "kernel" for every combination of schedule, chunk, binding,
+    lattice size and thread count.
+
+    Returns
+    -------
+    results : a list of the dicts of laplacian_benchmark.run_benchmarks,
+              with the OpenMP "environment" of each added
+    '''
+    results = []
+    for schedule, chunk, bind in itertools.product(schedules, chunks, binds):
+        if (schedule == "auto" and chunk > 0):
+            # auto takes no chunk size
+            continue
+        environment = omp_environment(schedule, chunk, bind, places)
+        try:
+            configuration = run_configuration(kernel, sizes, threads,
+                                              environment, repeats)
+        except subprocess.CalledProcessError as error:
+            print("Failed with {environment}: {error}".format(
+                environment=environment, error=error))
+            continue
+        for result in configuration:
+            result["environment"] = environment
+            results.append(result)
+            if (verbose):
+                print("{environment} size {size} threads {threads}: median "
+                      "{median:.4e} s (spread {relative_spread:.1%})".format(
+                          **result))
+    return results
+
+def best_configurations(results):
+    '''Return a dict of the fastest result for each lattice size.'''
+    best = {}
+    for result in results:
+        size = result["size"]
+        if (size not in best or result["median"] < best[size]["median"]):
+            best[size] = result
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sweep the OpenMP schedule and affinity of a kernel.")
+    parser.add_argument("--kernel", type=str,
+                        default="cyLaplacian6.cyLaplacian6",
+                        help="module.function name of the kernel")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 200],
+                        help="lattice sizes to sweep")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=[os.cpu_count() or 1],
+                        help="thread counts to sweep")
+    parser.add_argument("--schedules", type=str, nargs="+",
+                        default=["static", "dynamic", "guided"],
+                        help="OpenMP schedules to sweep")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[0, 1, 4, 16],
+                        help="chunk sizes to sweep, 0 for the default")
+    parser.add_argument("--binds", type=str, nargs="+",
+                        default=["false", "close", "spread"],
+                        help="OMP_PROC_BIND settings to sweep")
+    parser.add_argument("--places", type=str, default="cores",
+                        help="OMP_PLACES when the threads are bound")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="timed runs of each configuration")
+    parser.add_argument("--output", type=str, default="omp_sweep.json",
+                        help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+    results = sweep(args.kernel, args.sizes, args.threads, args.schedules,
+                    args.chunks, args.binds, args.places, args.repeats)
+    best = best_configurations(results)
+    for size, result in sorted(best.items()):
+        print("# {kernel} on {size}**3: {median:.4e} s".format(
+            kernel=args.kernel, size=size, median=result["median"]))
+        environment = dict(result["environment"],
+                           OMP_NUM_THREADS=result["threads"])
+        print("export "+" ".join("{name}={value}".format(name=name,
+                                                          value=value)
+                                 for name, value in sorted(environment.items())))
+    with open(args.output, "w") as datafile:
+        json.dump({"kernel": args.kernel,
+                   "best": dict((str(size), result)
+                                for size, result in best.items()),
+                   "results": results}, datafile, indent=1)
+    return best
+
+if (__name__ == "__main__"):
+    main()
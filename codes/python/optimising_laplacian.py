@@ -1,10 +1,13 @@
 import numpy
 import scipy
 import scipy.fftpack 
-import cProfile
-import time as timemod
-import pstats
 import os
+import laplacian_benchmark
+
+if (int(os.environ.get("OMP_NUM_THREADS", 1)) > 1):
+    # Init first touches the lattices for a static schedule, which the
+    # OpenMP runtime only picks up if set before any kernel is imported
+    laplacian_benchmark.static_schedule()
 
 def Laplacian0(data, lapl, d, N):
     for kk in range(1,data.shape[2]-1):
@@ -33,6 +36,10 @@ def Laplacian1(data, lapl, d, N):
     return
 
 def Init(size):
+    if (int(os.environ.get("OMP_NUM_THREADS", 1)) > 1):
+        # place the pages where the threads of cyLaplacian6 will use them
+        return laplacian_benchmark.first_touch_lattice(
+            size, int(os.environ["OMP_NUM_THREADS"]))
     d=numpy.array([0.1,0.1,0.1])
     data=numpy.random.random([size]*3)
     lapl=numpy.zeros_like(data)
@@ -48,42 +55,23 @@ def Laplacian2(data, lapl, d, N):
         /(d[2]*d[2]))
     return
 
-def RunOne(prof, func, *args):
-    prof.runcall(func, *args)
-    return
-
-def GetLtime(prof, function):
-    p=pstats.Stats(prof[function])
-    Ltime=[p.stats[x] for x in p.stats
-           if (x[2].startswith(function) or
-               x[2].startswith("<"+function) or
-               x[2].endswith(function+">"))][0][2]
-    return Ltime
-
-def RunSome(funcflops):
-    variables = Init(SIZE)
+def RunSome(funcflops, warmup=1, repeats=5):
+    '''Benchmark the kernels of "funcflops" on a SIZE**3 lattice with
+    laplacian_benchmark, print how they compare and append the results
+    to laplacian_benchmark.json.'''
     if ("OMP_NUM_THREADS" in os.environ):
         threads = int(os.environ["OMP_NUM_THREADS"])
     else:
         threads = 1
-    cp={}
-    times={}
-    funcs = [func["func"] for func in funcflops]
-    for funcflop in funcflops:
-        function=funcflop["func"]
-        LGF=funcflop["flop"]
-        cp[function]=cProfile.Profile()
-        start = timemod.clock()
-        RunOne(cp[function], eval(function), variables["data"],
-               variables["laplacian"], variables["lattice_spacing"],
-               threads)
-        end = timemod.clock()
-        times[function] = GetLtime(cp,function)
-        print("{func} executed in {time} (or {timemod}) at {GFps} GF/s".format(
-            func=function,
-            time=times[function],
-            GFps=LGF/times[function]/1e9,
-            timemod=end-start))
+    kernels = [{"func": funcflop["func"],
+                "flops_per_point": funcflop["flop"]/(SIZE-2)**3}
+               for funcflop in funcflops]
+    results = laplacian_benchmark.run_benchmarks(
+        kernels, [SIZE], [threads], warmup, repeats, namespace=globals(),
+        init=Init)
+    laplacian_benchmark.save_results("laplacian_benchmark.json", results)
+    times = dict((result["func"], result["median"]) for result in results)
+    funcs = [func["func"] for func in funcflops if func["func"] in times]
     print("Speedup between {f0} and {fN}: {slowfast}".format(
         slowfast=times[funcs[0]]/times[funcs[-1]],
         f0=funcs[0],
@@ -93,7 +81,7 @@ def RunSome(funcflops):
             slowfast=times[funcs[-2]]/times[funcs[-1]],
             fNm1=funcs[-2],
             fN=funcs[-1]))
-    return (cp,times)
+    return (results,times)
 
 SIZE=100
 RunList=[{"func":"Laplacian2", "flop":(SIZE-2)**3*17}]
@@ -113,31 +101,30 @@ SIZE=200
 RunList.append({"func":"Laplacian3", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import pyximport
-pyximport.install(setup_args={'include_dirs': numpy.get_include()})
 import sys
 sys.path = ["../codes/python"]+sys.path
-import cyLaplacian1
+# built with setup_kernels.py, or compiled by pyximport on first import
+cyLaplacian1 = laplacian_benchmark.import_kernel_module("cyLaplacian1")
 RunList.append({"func":"cyLaplacian1.cyLaplacian1", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import cyLaplacian2
+cyLaplacian2 = laplacian_benchmark.import_kernel_module("cyLaplacian2")
 RunList.append({"func":"cyLaplacian2.cyLaplacian2", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import cyLaplacian3
+cyLaplacian3 = laplacian_benchmark.import_kernel_module("cyLaplacian3")
 RunList.append({"func":"cyLaplacian3.cyLaplacian3", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import cyLaplacian4
+cyLaplacian4 = laplacian_benchmark.import_kernel_module("cyLaplacian4")
 RunList.append({"func":"cyLaplacian4.cyLaplacian3", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import cyLaplacian5
+cyLaplacian5 = laplacian_benchmark.import_kernel_module("cyLaplacian5")
 RunList.append({"func":"cyLaplacian5.cyLaplacian5", "flop":(SIZE-2)**3*14+3})
 results = RunSome(RunList)
 
-import cyLaplacian6
+cyLaplacian6 = laplacian_benchmark.import_kernel_module("cyLaplacian6")
 SIZE=500
 RunList.append({"func":"cyLaplacian6.cyLaplacian6", "flop":(SIZE-2)**3*14+3})
 RunList = [{"func":x["func"], "flop":(SIZE-2)**3*14+3} for x in RunList[1:]]
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import time
 import numpy
 import mpi4py
 from mpi4py import MPI
@@ -8,11 +7,11 @@ def ping_master(masterrank):
     times = []
     for rank in range(MPI.COMM_WORLD.size):
         if rank != masterrank:
-            t1 = time.clock()
+            t1 = MPI.Wtime()
             data = numpy.array([1.0])
             MPI.COMM_WORLD.Send([data, MPI.DOUBLE], dest=rank, tag=0)
             MPI.COMM_WORLD.Recv([data, MPI.DOUBLE], source=rank, tag=0)
-            t2 = time.clock()
+            t2 = MPI.Wtime()
             times.append(t2-t1)
     print("Average ping-pong time was {av}.".format(av=sum(times)/len(times)))
     return
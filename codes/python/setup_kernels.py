@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''Build all the Cython Laplacian kernels ahead of time.
+
+pyximport compiles each cyLaplacian*.pyx the first time it is imported
+on a machine, which costs tens of seconds on every fresh node. Instead
+run once, e.g. in the job script or when installing the environment,
+
+    python3 setup_kernels.py build_ext --inplace
+
+to compile every kernel next to its .pyx file. The compiler flags (for
+example OpenMP for cyLaplacian6) come from the make_ext of each .pyxbld
+file, exactly as pyximport would use them, so there is only one place to
+change them. The built modules are imported like any other module and
+take precedence over pyximport; laplacian_benchmark.import_kernel_module
+falls back to pyximport only for kernels which have not been built.
+
+Set CYTHON_KERNELS to a space separated list of module names to build
+only some of them, and CYTHON_NTHREADS to compile them in parallel.
+'''
+import glob
+import os
+import sys
+import numpy
+import setuptools
+from Cython.Build import cythonize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def kernel_sources():
+    '''Return the .pyx files of the kernels to build, relative to this
+    directory.'''
+    if ("CYTHON_KERNELS" in os.environ):
+        return [name+".pyx" for name in os.environ["CYTHON_KERNELS"].split()]
+    return sorted(os.path.basename(filename)
+                  for filename in glob.glob(os.path.join(HERE, "cy*.pyx")))
+
+def make_extension(pyxfilename):
+    '''Return the Extension of "pyxfilename", made by its .pyxbld file if
+    there is one.'''
+    modname = os.path.splitext(pyxfilename)[0]
+    pyxbld = os.path.join(HERE, modname+".pyxbld")
+    if (os.path.exists(pyxbld)):
+        namespace = {}
+        with open(pyxbld) as buildfile:
+            exec(compile(buildfile.read(), pyxbld, "exec"), namespace)
+        extension = namespace["make_ext"](modname, pyxfilename)
+    else:
+        extension = setuptools.Extension(name=modname, sources=[pyxfilename],
+                                         language="c")
+    extension.include_dirs = list(extension.include_dirs)+[numpy.get_include()]
+    return extension
+
+if (__name__ == "__main__"):
+    os.chdir(HERE)
+    if (len(sys.argv) == 1):
+        sys.argv += ["build_ext", "--inplace"]
+    setuptools.setup(
+        name="cylaplacian",
+        ext_modules=cythonize([make_extension(source)
+                               for source in kernel_sources()],
+                              nthreads=int(os.environ.get("CYTHON_NTHREADS", 0)),
+                              language_level="3str"),
+        zip_safe=False)